@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#coding: utf-8
+import os
+import re
+import mmap
+import zlib
+import traceback
+import multiprocessing
+import batch
+import fetch
+
+# memory-mapped WARC and concatenated-html archives
+# the archive is indexed once by record offsets, a record's bytes are
+# only sliced out of the map when it is extracted
+# an index entry is (uri, offset, length, content_type, encodings), where
+# offset/length locate the html body and encodings is the http
+# Transfer-Encoding and Content-Encoding still to undo, e.g. 'chunked,gzip'
+
+_html_end = re.compile(r'</html\s*>', re.I)
+_blank = re.compile(r'\s*')
+
+class ArchiveError(Exception):
+    pass
+
+def parse_headers(text):
+    # 'Name: value' lines after the first one, names lower-cased
+    headers = {}
+    for line in text.split('\r\n')[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def warc_index(data, path=''):
+    index = []
+    pos = 0
+    size = len(data)
+    while True:
+        pos = _blank.match(data, pos).end()
+        if pos >= size: break
+        end = data.find('\r\n\r\n', pos)
+        if data[pos:pos+5] != 'WARC/' or end < 0:
+            raise ArchiveError('%s: no WARC record at offset %d' % (path, pos))
+        headers = parse_headers(data[pos:end])
+        start = end + 4
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            raise ArchiveError('%s: bad Content-Length at offset %d' % (path, pos))
+        pos = start + length
+        if headers.get('warc-type') != 'response' or \
+           not headers.get('content-type', '').startswith('application/http'):
+            continue
+
+        # the http response inside the block
+        end = data.find('\r\n\r\n', start, pos)
+        if end < 0: continue
+        http = parse_headers(data[start:end])
+        content_type = http.get('content-type', '')
+        if content_type and 'html' not in content_type.lower(): continue
+        encodings = [e.strip().lower() for e in (http.get('transfer-encoding', ''), http.get('content-encoding', ''))]
+        index.append((headers.get('warc-target-uri', ''), end + 4, pos - end - 4,
+                      content_type, ','.join(e for e in encodings if e in ('chunked', 'gzip', 'deflate'))))
+    return index
+
+def html_index(data, path=''):
+    # pages one after another, each ending at </html>
+    index = []
+    pos = 0
+    for m in _html_end.finditer(data):
+        start = _blank.match(data, pos).end()
+        index.append(('%s#%d' % (path, len(index)), start, m.end() - start, '', ''))
+        pos = m.end()
+    start = _blank.match(data, pos).end()
+    if start < len(data):
+        index.append(('%s#%d' % (path, len(index)), start, len(data) - start, '', ''))
+    return index
+
+def dechunk(body):
+    content = []
+    pos = 0
+    while True:
+        end = body.find('\r\n', pos)
+        if end < 0: break
+        try:
+            n = int(body[pos:end].split(';')[0], 16)
+        except ValueError:
+            break
+        if n == 0: break
+        content.append(body[end+2:end+2+n])
+        pos = end + 2 + n + 2
+    return ''.join(content)
+
+def decode_body(body, encodings):
+    for e in encodings.split(','):
+        if e == 'chunked':
+            body = dechunk(body)
+        elif e in ('gzip', 'deflate'):
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS if e == 'gzip' else zlib.MAX_WBITS)
+            except zlib.error:
+                body = ''
+    return body
+
+def shards(size, n):
+    # n contiguous (start, end) ranges of record numbers
+    return [(size * k / n, size * (k + 1) / n) for k in xrange(n)]
+
+class Archive(object):
+    # len(), archive[i] -> (uri, raw_html, content_type) and iteration
+    def __init__(self, path, index=None):
+        self.path = path
+        self.fp = open(path, 'rb')
+        if os.fstat(self.fp.fileno()).st_size:
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = ''
+        if index is None:
+            if self.map[:2] == '\x1f\x8b':
+                self.close()
+                raise ArchiveError('%s: gzip-compressed, decompress it first' % path)
+            if self.map[:5] == 'WARC/':
+                index = warc_index(self.map, path)
+            else:
+                index = html_index(self.map, path)
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.read(self.index[i])
+
+    def __iter__(self):
+        for entry in self.index:
+            yield self.read(entry)
+
+    def read(self, entry):
+        uri, offset, length, content_type, encodings = entry
+        return uri, decode_body(self.map[offset:offset+length], encodings), content_type
+
+    def shards(self, n):
+        return shards(len(self.index), n)
+
+    def close(self):
+        if self.map: self.map.close()
+        self.fp.close()
+
+_archive = None
+
+def _init_worker(cls, path, settings=None):
+    # each worker maps the archive once, the pages are shared with the
+    # other workers through the page cache
+    global _archive
+    batch._init_worker(cls, settings)
+    _archive = Archive(path, [])
+
+def _extract(task):
+    entries, thres = task
+    results = []
+    for entry in entries:
+        try:
+            uri, raw_html, content_type = _archive.read(entry)
+            results.append((uri, batch._extractor.extract(fetch.normalize(raw_html, content_type), thres), ''))
+        except Exception:
+            results.append((entry[0], None, traceback.format_exc()))
+    return results
+
+def extract_archive(cls, path, workers=None, shard=None, chunksize=64, ordered=True, thres=0, settings=None):
+    # yield (uri, ExtractResult, err) for each html record of the archive,
+    # shard=(k, n) only takes the k-th of n contiguous record ranges
+    archive = Archive(path)
+    index = archive.index
+    archive.close()
+    if shard:
+        start, end = shards(len(index), shard[1])[shard[0]]
+        index = index[start:end]
+    tasks = ((index[i:i+chunksize], thres) for i in xrange(0, len(index), chunksize))
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        global _archive
+        _init_worker(cls, path, settings)
+        try:
+            for task in tasks:
+                for result in _extract(task):
+                    yield result
+        finally:
+            _archive.close()
+            _archive = None
+        return
+
+    pool = multiprocessing.Pool(workers, _init_worker, (cls, path, settings))
+    try:
+        tasks = ((_extract, task) for task in tasks)
+        if ordered:
+            results = pool.imap(batch._run, tasks)
+        else:
+            results = pool.imap_unordered(batch._run, tasks)
+        for item in results:
+            for result in batch._count(item, settings):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    import sys
+    from sf_extractor import SFExtractor
+    for uri, result, err in extract_archive(SFExtractor, sys.argv[1]):
+        print '\nurl:', uri
+        if err:
+            print 'error_msg:', err
+            continue
+        print 'title:', result.title
+        print 'content:', result.content
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#coding: utf-8
+import traceback
+import multiprocessing
+from operator import sub
+
+# batch extraction over a process pool
+# each worker builds its extractor once and keeps it for all its pages
+# the workers' cache lookups, marker rule matches and profiles are
+# counted in the extractor's cache, marker registry and profiler
+
+_extractor = None
+
+def settings(extractor):
+    # the settings set on an extractor, which the workers' extractors are
+    # rebuilt from; the attributes named in its class's worker_local
+    # (counters, locks) are each process's own
+    local = getattr(extractor.__class__, 'worker_local', ())
+    return dict((k, v) for k, v in vars(extractor).iteritems() if k not in local)
+
+def _init_worker(cls, settings=None):
+    global _extractor
+    _extractor = cls()
+    _extractor.__dict__.update(settings or {})
+
+def _extract(task):
+    i, text, thres = task
+    try:
+        return i, _extractor.extract(text, thres), ''
+    except Exception:
+        return i, None, traceback.format_exc()
+
+def _registry(settings):
+    # the markers.MarkerRegistry of an extractor's settings, a cascade's
+    # is its SFExtractor's
+    slow = settings.get('slow')
+    return slow.markers if slow is not None else settings.get('markers')
+
+def _run(task):
+    # f(args) in a worker, with what it added to the worker's cache and
+    # marker counts and the Profiles of its extract() calls
+    f, args = task
+    cache, registry, profiler = _extractor.cache, _registry(vars(_extractor)), _extractor.profiler
+    cache_before = cache.counts() if cache is not None else None
+    markers_before = registry.report() if registry is not None else None
+    profiles = []
+    if profiler is not None: _extractor.profiler = profiles.append
+    try:
+        result = f(args)
+    finally:
+        _extractor.profiler = profiler
+    cache_counts = map(sub, cache.counts(), cache_before) if cache is not None else None
+    marker_counts = None
+    if registry is not None:
+        stats, fallbacks = registry.report()
+        marker_counts = (dict((k, map(sub, v, markers_before[0].get(k, (0, 0)))) for k, v in stats.iteritems()),
+                         fallbacks - markers_before[1])
+    return result, (cache_counts, marker_counts, profiles)
+
+def _count(item, settings):
+    # the result of a _run task, its counts added to the parent's cache
+    # and marker registry, its profiles passed to the parent's profiler
+    result, (cache_counts, marker_counts, profiles) = item
+    settings = settings or {}
+    cache, registry, profiler = settings.get('cache'), _registry(settings), settings.get('profiler')
+    if cache_counts and cache is not None: cache.add_counts(cache_counts)
+    if marker_counts and registry is not None: registry.add_counts(marker_counts)
+    if profiler is not None:
+        for profile in profiles: profiler(profile)
+    return result
+
+def extract_many(cls, texts, workers=None, chunksize=16, ordered=True, thres=0, settings=None):
+    # yield (index, ExtractResult, err) for each text,
+    # err is the formatted traceback of a failed page and '' otherwise
+    tasks = ((i, text, thres) for i, text in enumerate(texts))
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        _init_worker(cls, settings)
+        for task in tasks:
+            yield _extract(task)
+        return
+
+    pool = multiprocessing.Pool(workers, _init_worker, (cls, settings))
+    try:
+        tasks = ((_extract, task) for task in tasks)
+        if ordered:
+            results = pool.imap(_run, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_run, tasks, chunksize)
+        for item in results:
+            yield _count(item, settings)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#coding: utf-8
+import os
+import sys
+import json
+import time
+import random
+import difflib
+import resource
+import multiprocessing
+import fetch
+import profiling
+from sf_extractor import SFExtractor
+from cx_extractor import CXExtractor
+from cascade import CascadeExtractor
+
+# offline benchmarks
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+def load_corpus(path=corpus_dir):
+    # saved pages, normalized to utf-8 like downloaded ones
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.html'):
+            with open(os.path.join(path, name), 'rb') as fp:
+                pages.append((name, fetch.normalize(fp.read())))
+    return pages
+
+_words = ['新闻', '北京', '记者', '报道', '经济', '发展', '今天', '我们', '中国', '公司', 'the', 'market', 'data']
+_puncs = ['，', '。', '、', '：', '！', '？']
+
+def synthetic_page(seed=0, size=50000, line_len=80, link_density=0.2, blank_run=1):
+    # a page of about `size` bytes of text lines of about `line_len` bytes,
+    # `link_density` of them links, separated by runs of `blank_run` blank lines
+    r = random.Random(seed)
+    out = ['<html>\n<head>\n<title>%s_synthetic</title>\n' % ''.join(r.sample(_words, 4)),
+           '<meta name="keywords" content="%s">\n' % ','.join(r.sample(_words, 3)),
+           '<meta name="description" content="%s">\n</head>\n<body>\n' % ''.join(r.sample(_words, 6))]
+    n = 0
+    while n < size:
+        line = []
+        while sum(len(w) for w in line) < line_len:
+            line.append(r.choice(_words))
+            if r.random() < 0.2: line.append(r.choice(_puncs))
+        line = ''.join(line)
+        if r.random() < link_density:
+            line = '<a href="/%d.html" target="_blank">%s</a>' % (r.randint(1, 10**6), line)
+        else:
+            line = '<p>%s</p>' % line
+        out.append(line + '\n' * (blank_run + 1))
+        n += len(line)
+    out.append('</body>\n</html>\n')
+    return ''.join(out)
+
+def synthetic_corpus(scale=1):
+    # one page set per dimension, each scaling a single parameter
+    sets = []
+    for size in (10000, 100000, 1000000):
+        sets.append(('size=%d' % (size * scale), [synthetic_page(i, size=size * scale) for i in xrange(3)]))
+    for line_len in (20, 200, 2000):
+        sets.append(('line_len=%d' % line_len, [synthetic_page(i, size=100000 * scale, line_len=line_len) for i in xrange(3)]))
+    for link_density in (0.0, 0.5, 0.9):
+        sets.append(('link_density=%.1f' % link_density, [synthetic_page(i, size=100000 * scale, link_density=link_density) for i in xrange(3)]))
+    for blank_run in (0, 5, 50):
+        sets.append(('blank_run=%d' % blank_run, [synthetic_page(i, size=100000 * scale, blank_run=blank_run) for i in xrange(3)]))
+    return sets
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values: return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def _measure((cls, pages, repeat)):
+    # run in a fresh process, so ru_maxrss is this run's peak
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    extractor = cls()
+    latencies = []
+    stage_times = {}
+    start_time = time.time()
+    for i in xrange(repeat):
+        for page in pages:
+            t = time.time()
+            extractor.extract(page)
+            latencies.append(time.time() - t)
+    total = time.time() - start_time
+    # stage times from one more, profiled, pass
+    extractor.profiler = stats = profiling.ProfileStats()
+    for page in pages:
+        extractor.extract(page)
+    for name, h in stats.histograms.iteritems():
+        if name.endswith('.ms'):
+            stage_times[name[:-3]] = h.mean()
+    return {
+        'pages': len(pages),
+        'bytes': sum(len(page) for page in pages),
+        'qps': len(latencies) / total if total else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss,
+        'stage_ms': stage_times,
+    }
+
+def measure(cls, pages, repeat=5):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_measure, ((cls, pages, repeat),))
+    finally:
+        pool.terminate()
+
+def bench_suite(path=None, repeat=5, scale=1):
+    # every page set against both extractors, results also saved as json
+    page_sets = [('corpus', [page for name, page in load_corpus()])] + synthetic_corpus(scale)
+    results = {}
+    for cls in (SFExtractor, CXExtractor):
+        print cls.__name__.center(60, '-')
+        results[cls.__name__] = {}
+        for name, pages in page_sets:
+            result = measure(cls, pages, repeat)
+            results[cls.__name__][name] = result
+            print '%-18s qps %8.1f  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  rss %7dKB' % (
+                name, result['qps'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['peak_rss_kb'])
+            print '%-18s %s' % ('', '  '.join('%s %.2fms' % (k, v) for k, v in sorted(result['stage_ms'].items())))
+    if path:
+        with open(path, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return results
+
+def legacy_normalize(raw_html):
+    # the charset loop fetch.normalize replaced
+    best_match = ('', 0)
+    for charset in ['utf-8', 'gbk', 'big5', 'gb18030']:
+        try:
+            unicode_html = raw_html.decode(charset, 'ignore')
+            guess_html = unicode_html.encode(charset)
+            if len(guess_html) == len(raw_html):
+                best_match = (charset, len(guess_html))
+                break
+            elif len(guess_html) > best_match[1]:
+                best_match = (charset, len(guess_html))
+        except: 
+            pass
+    return raw_html.decode(best_match[0], 'ignore').encode('utf-8')
+
+def charset_pages(seed=0, size=200000):
+    # the same chinese page in each fallback charset, with and without
+    # a <meta> declaration
+    r = random.Random(seed)
+    words = [u'北京', u'今天', u'公司', u'人民', u'上海', u'文化', u'工作', u'market', u'，', u'。']
+    body = []
+    n = 0
+    while n < size:
+        line = u''.join(r.choice(words) for i in xrange(r.randint(5, 40)))
+        body.append(u'<p>%s</p>\n' % line)
+        n += len(line) * 2
+    body = u''.join(body)
+    pages = []
+    for charset in fetch.charsets:
+        for meta in ('', '<meta http-equiv="Content-Type" content="text/html; charset=%s">' % charset):
+            page = u'<html><head>%s<title>t</title></head><body>%s</body></html>' % (meta, body)
+            pages.append((charset + (' meta' if meta else ''), page.encode(charset)))
+    return pages
+
+def bench_charset(repeat=5):
+    print 'charset detection'.center(60, '-')
+    for name, page in charset_pages():
+        times = []
+        for f in (legacy_normalize, fetch.normalize):
+            start_time = time.time()
+            for i in xrange(repeat):
+                f(page)
+            times.append((time.time() - start_time) / repeat * 1000)
+        print '%-14s %8d bytes  legacy %7.2fms  normalize %7.2fms  same: %s' % (
+            name, len(page), times[0], times[1], legacy_normalize(page) == fetch.normalize(page))
+
+def adversarial_pages(n):
+    # pages that made the old _ad_links, _comment_links and _special_tag
+    # regexes backtrack, n is the number of repeated units
+    pages = [
+        ('long attrs', ('<a  href=u ' + 'x ' * n + '>' + 'y' * 60 + '</a>') * 3),
+        ('open tags', '<' * n + '"' + 'x' * 501 + '"'),
+        ('quoted runs', '<"' * n),
+        ('nested links', '<a ' * n + '>t</a>'),
+        ('href runs', '<a  ' + 'href=' * n + '>t</a>'),
+        ('broken chain', '<a  href=u x>t</a> ' * n + 'y' * 50),
+        ('open spans', '<span' * n),
+        ('span chain', '<span>t</span>x' * n),
+    ]
+    return [(name, '<html><body>%s</body></html>' % page) for name, page in pages]
+
+def bench_adversarial(size=20000, bound=2.0):
+    # preprocess must stay linear: 4x the input in at most `bound` seconds
+    print 'adversarial pages'.center(60, '-')
+    extractor = CXExtractor()
+    ok = True
+    for (name, page), (_, page4) in zip(adversarial_pages(size), adversarial_pages(size * 4)):
+        times = []
+        for p in (page, page4):
+            start_time = time.time()
+            extractor.preprocess(p)
+            times.append(time.time() - start_time)
+        passed = times[1] <= bound
+        ok = ok and passed
+        print '%-14s %8d bytes %7.3fs  %8d bytes %7.3fs  %s' % (
+            name, len(page), times[0], len(page4), times[1], 'ok' if passed else 'SLOW')
+    return ok
+
+def bench_cascade(path=corpus_dir, repeat=5, agree_ratio=0.9):
+    # mean latency of SFExtractor against the cascade, and how often the
+    # cascade's content matches SFExtractor's, agree_ratio being the
+    # least share of matching characters, in order, that counts as the
+    # same content
+    print 'cascade'.center(60, '-')
+    pages = [page for name, page in load_corpus(path)]
+    sf, cascade = SFExtractor(), CascadeExtractor()
+    times = []
+    for extractor in (sf, cascade):
+        start_time = time.time()
+        for i in xrange(repeat):
+            results = [extractor.extract(page) for page in pages]
+        times.append((time.time() - start_time) / repeat / len(pages) * 1000)
+    expected = [sf.extract(page).content for page in pages]
+    agree = {'cx': 0, 'sf': 0}
+    for result, content in zip(results, expected):
+        if result.content == content or \
+           difflib.SequenceMatcher(None, result.content, content, autojunk=False).ratio() >= agree_ratio:
+            agree[result.route] += 1
+    routes = dict((k, v / repeat) for k, v in cascade.stats().iteritems())
+    print 'pages %d  sf %.2fms  cascade %.2fms  saving %.1f%%' % (
+        len(pages), times[0], times[1], 100.0 * (times[0] - times[1]) / times[0])
+    print 'routes cx %d sf %d  agreement %.1f%% (cx %d/%d)' % (
+        routes['cx'], routes['sf'], 100.0 * sum(agree.values()) / len(pages), agree['cx'], routes['cx'])
+    print 'use the cascade' if times[1] < times[0] else 'keep SFExtractor, the cascade is not faster'
+    return {'pages': len(pages), 'sf_ms': times[0], 'cascade_ms': times[1], 'routes': routes,
+            'agreement': float(sum(agree.values())) / len(pages), 'faster': times[1] < times[0]}
+
+if __name__ == '__main__':
+    # python benchmark.py [results.json]
+    bench_suite(sys.argv[1] if len(sys.argv) == 2 else None)
+    bench_charset()
+    bench_cascade()
+    if not bench_adversarial():
+        sys.exit(1)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#coding: utf-8
+import threading
+from collections import OrderedDict
+
+# per-site boilerplate learned from extracted pages
+# lines outside the chosen content are counted per site, a line seen on
+# min_pages pages of the site is boilerplate, and a block made only of
+# boilerplate lines is neither scored nor merged into the content
+# sites and each site's lines are evicted least recently seen first
+
+class SiteTemplate(object):
+    __slots__ = ('pages', 'lines')
+
+    def __init__(self):
+        self.pages = 0
+        self.lines = OrderedDict()
+
+class BoilerplateCache(object):
+    def __init__(self, max_sites=1000, max_lines=2000, min_pages=3):
+        self.max_sites = max_sites
+        self.max_lines = max_lines
+        self.min_pages = min_pages
+        self.sites = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, site):
+        with self.lock:
+            template = self.sites.pop(site, None)
+            if template is not None:
+                self.sites[site] = template
+            return template
+
+    def is_boilerplate(self, template, lines, istart, iend):
+        # every non-empty line of the block is known
+        known = template.lines
+        found = False
+        for line in lines[istart:iend]:
+            if not line: continue
+            if known.get(hash(line), 0) < self.min_pages:
+                return False
+            found = True
+        if found:
+            with self.lock:
+                self.hits += 1
+        return found
+
+    def learn(self, site, lines, span):
+        # count the lines outside span once per page
+        istart, iend = span or (0, 0)
+        seen = set(hash(line) for line in lines[:istart] if line)
+        seen.update(hash(line) for line in lines[iend:] if line)
+        with self.lock:
+            template = self.sites.pop(site, None)
+            if template is None:
+                template = SiteTemplate()
+                if len(self.sites) >= self.max_sites:
+                    self.sites.popitem(last=False)
+                    self.evictions += 1
+            self.sites[site] = template
+            template.pages += 1
+            known = template.lines
+            for h in seen:
+                known[h] = known.pop(h, 0) + 1
+            while len(known) > self.max_lines:
+                known.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'sites': len(self.sites), 'hits': self.hits, 'evictions': self.evictions,
+                    'lines': sum(len(t.lines) for t in self.sites.itervalues())}
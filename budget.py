@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#coding: utf-8
+import time
+
+# per-page limits of an extract() call, so one huge or adversarial page
+# cannot stall a worker
+# set extractor.budget to a Budget, None (the default) for no limits; a
+# page over a limit is still extracted, in a cheaper way, and the
+# result's degraded names the limits it hit, e.g. 'bytes,merge_steps':
+#   bytes        only the first max_bytes of the page are read
+#   lines        only the first max_lines lines are split into blocks
+#   blocks       only the max_blocks longest blocks are scored and merged
+#                (SFExtractor)
+#   merge_steps  merging stops, keeping the content so far
+#   deadline     seconds from the start of the call, checked between
+#                stages and merge steps: merging stops, SFExtractor takes
+#                the longest block when the blocks are not scored yet,
+#                and a cascade keeps CXExtractor's content
+
+class Budget(object):
+    def __init__(self, max_bytes=None, max_lines=None, max_blocks=None, max_merge_steps=None, deadline=None):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.max_blocks = max_blocks
+        self.max_merge_steps = max_merge_steps
+        self.deadline = deadline
+
+    def start(self):
+        return Usage(self)
+
+    def __repr__(self):
+        return 'Budget(max_bytes=%r, max_lines=%r, max_blocks=%r, max_merge_steps=%r, deadline=%r)' % \
+               (self.max_bytes, self.max_lines, self.max_blocks, self.max_merge_steps, self.deadline)
+
+class Usage(object):
+    # one call's budget: when it ends and the limits hit so far
+    __slots__ = ('budget', 'end_time', 'hit')
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.end_time = time.time() + budget.deadline if budget.deadline is not None else None
+        self.hit = []
+
+    def flag(self, name):
+        if name not in self.hit:
+            self.hit.append(name)
+
+    def cut(self, name, seq, limit):
+        # seq, or its first limit items
+        if limit is None or len(seq) <= limit: return seq
+        self.flag(name)
+        return seq[:limit]
+
+    def over(self, name, n, limit):
+        if limit is None or n < limit: return False
+        self.flag(name)
+        return True
+
+    def expired(self):
+        if self.end_time is None or time.time() < self.end_time: return False
+        self.flag('deadline')
+        return True
+
+    def degraded(self):
+        return ','.join(self.hit) or None
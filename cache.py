@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#coding: utf-8
+import os
+import marshal
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from result import ExtractResult
+
+# extraction results keyed by a hash of the page, the extractor class, the
+# threshold and the extractor's settings that change the result (its
+# cache_config: language, budget, fingerprint settings, marker rules and
+# the site they apply to): a bounded in-memory LRU in front of an optional
+# sqlite file, which is shared by processes and kept between runs
+
+class ResultCache(object):
+    def __init__(self, size=10000, path=None):
+        self.size = size
+        self.path = path
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = None
+        self.pid = None
+
+    def key(self, extractor, text, thres, site=None, digest=None):
+        # None when the page's result is not to be cached; digest is the
+        # page's sha1 hexdigest, for a page fed in chunks instead of text
+        config = extractor.cache_config(site)
+        if config is None: return None
+        return '%s:%d:%s:%s' % (extractor.__class__.__name__, thres, config, digest or hashlib.sha1(text).hexdigest())
+
+    def db(self):
+        # one connection per process, a forked worker opens its own
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)')
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def remember(self, key, state):
+        self.memory[key] = state
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        with self.lock:
+            state = self.memory.pop(key, None)
+            if state is not None:
+                self.memory[key] = state
+                self.hits += 1
+            elif self.path:
+                row = self.db().execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                if row:
+                    state = marshal.loads(str(row[0]))
+                    self.remember(key, state)
+                    self.disk_hits += 1
+            if state is None:
+                self.misses += 1
+                return None
+        return ExtractResult(*state)
+
+    def put(self, key, result):
+        state = result.__getstate__()
+        with self.lock:
+            self.remember(key, state)
+            if self.path:
+                db = self.db()
+                db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, sqlite3.Binary(marshal.dumps(state))))
+                db.commit()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self.memory)}
+
+    def counts(self):
+        # the lookup counters, a pool worker's go back to the parent's cache
+        with self.lock:
+            return (self.hits, self.disk_hits, self.misses, self.evictions)
+
+    def add_counts(self, counts):
+        with self.lock:
+            hits, disk_hits, misses, evictions = counts
+            self.hits += hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#coding: utf-8
+import re
+import time
+import threading
+import batch
+import archive
+import profiling
+from result import ExtractResult
+from sf_extractor import SFExtractor
+from cx_extractor import CXExtractor
+
+# the cheap CXExtractor first, SFExtractor only for the pages it is not
+# confident about
+# the confidence is the product of three scores in [0, 1]: the content's
+# share of the page's bytes against full_ratio, its length against
+# full_length, and the number of surges merged into it against max_runs,
+# since a content stitched from many surges is usually mixed with noise
+# a page with more than max_links links per 1000 bytes, a portal or an
+# index that CXExtractor is rarely confident about, goes to SFExtractor
+# without running CXExtractor first, and so does a page CXExtractor
+# fails on
+# title, keywords and description come from SFExtractor's meta data pass
+# over the head whatever the route
+# with a budget.Budget, a page out of time after CXExtractor keeps its
+# content whatever the confidence
+# the cascade is opt-in: it is only worth it for crawls where
+# benchmark.bench_cascade shows it faster than SFExtractor, that is with
+# few pages falling back, and it agrees less with SFExtractor than
+# SFExtractor run alone
+
+class CascadeExtractor(object):
+    # pages below this confidence go to SFExtractor
+    min_confidence = 0.5
+    full_ratio = 0.45
+    full_length = 500
+    max_runs = 3
+    max_links = 6.0
+    # as in SFExtractor and CXExtractor
+    profiler = None
+    cache = None
+    budget = None
+    fingerprint = None
+    # counted per process, not copied into batch workers
+    worker_local = ('routes', 'lock')
+    _link = re.compile(r'<a\s', re.I)
+
+    def __init__(self):
+        self.fast = CXExtractor()
+        self.slow = SFExtractor()
+        self.routes = {'cx': 0, 'sf': 0}
+        self.lock = threading.Lock()
+
+    def confidence(self, raw_len, content, runs):
+        if not content or not runs: return 0.0
+        ratio = min(1.0, float(len(content)) / raw_len / self.full_ratio)
+        length = min(1.0, float(len(content)) / self.full_length)
+        return ratio * length * min(1.0, float(self.max_runs) / runs)
+
+    def links(self, text):
+        # <a tags per 1000 bytes
+        if not text: return 0.0
+        return len(self._link.findall(text)) * 1000.0 / len(text)
+
+    def cache_config(self, site=None):
+        # the routing settings and SFExtractor's
+        slow = self.slow.cache_config(site)
+        if slow is None: return None
+        return '%r:%r:%r:%r:%r:%r:%r:%s' % (self.min_confidence, self.full_ratio, self.full_length, self.max_runs,
+                                            self.max_links, self.budget, self.fingerprint, slow)
+
+    def extract(self, text, _thres=0, site=None):
+        # _thres is CXExtractor's, SFExtractor runs with its default
+        if not text: return ExtractResult()
+        key = self.cache and self.cache.key(self, text, _thres, site)
+        if key:
+            result = self.cache.get(key)
+            if result is not None: return result
+        # the profile also counts the surges CXExtractor merged
+        prof = profiling.Profile()
+        usage = self.budget and self.budget.start()
+        if usage: text = usage.cut('bytes', text, usage.budget.max_bytes)
+        cx = self.fast
+
+        cx_done = self.links(text) <= self.max_links
+        if cx_done:
+            t = time.time()
+            try:
+                clean = cx.preprocess(text)
+                content, span = cx.extract_block(clean, _thres or cx.default_threshold, prof, usage)
+            except Exception:
+                # a page CXExtractor fails on is SFExtractor's
+                cx_done = False
+                prof.count('cx_errors')
+            else:
+                prof.stage('cx', t, len(text), len(content))
+        if cx_done and \
+           (self.confidence(len(text), content, prof.counters.get('merge_steps', 0)) >= self.min_confidence or
+            usage and usage.expired()):
+            t = time.time()
+            meta = self.slow.extract_head_meta(text)
+            prof.stage('metadata', t, len(text), len(meta['title']) + len(meta['keywords']) + len(meta['description']))
+            result = ExtractResult(meta['title'], content, meta['keywords'], meta['description'], span, 'cx',
+                                   usage and usage.degraded(), og=meta['og'], charset=meta['charset'])
+        else:
+            t = time.time()
+            result = self.slow.extract(text, site=site, usage=usage)
+            result.route = 'sf'
+            prof.stage('sf', t, len(text), len(result.content))
+        if self.fingerprint:
+            t = time.time()
+            self.fingerprint.fill(result)
+            prof.stage('fingerprint', t, len(result.content))
+        with self.lock:
+            self.routes[result.route] += 1
+        if self.profiler:
+            prof.count('route_' + result.route)
+            if result.degraded: prof.count('degraded')
+            self.profiler(prof)
+        if key and not result.degraded: self.cache.put(key, result)
+        return result
+
+    def stats(self):
+        # pages by route
+        with self.lock:
+            return dict(self.routes)
+
+    def extract_many(self, texts, workers=None, chunksize=16, ordered=True, _thres=0):
+        return batch.extract_many(self.__class__, texts, workers, chunksize, ordered, _thres, batch.settings(self))
+
+    def extract_archive(self, path, workers=None, shard=None, ordered=True, _thres=0):
+        return archive.extract_archive(self.__class__, path, workers, shard, ordered=ordered, thres=_thres,
+                                       settings=batch.settings(self))
+
+if __name__ == '__main__':
+    import sys
+    import fetch
+    ext = CascadeExtractor()
+    for url in sys.argv[1:]:
+        result = ext.extract(fetch.download_and_normalize(url))
+        print '\nurl:', url
+        print 'route:', result.route
+        print 'title:', result.title
+        print 'content:', result.content
@@ -2,7 +2,39 @@
 # coding: utf-8
 import re
 import time
-import urllib
+import bisect
+import batch
+import cache
+import archive
+import fetch
+import profiling
+from array import array
+from operator import sub
+from lineindex import LineIndex
+from result import ExtractResult
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def fold_case(pattern):
+    # 把[]外的字母写成[xX], 代替re.I: 有re.I时sre不能按开头的字面量快速跳过
+    out = []
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        x = pattern[i]
+        if x == '\\':
+            x = pattern[i:i+2]
+        elif in_class:
+            in_class = x != ']'
+        elif x == '[':
+            in_class = True
+        elif x.isalpha():
+            x = '[%s%s]' % (x.lower(), x.upper())
+        out.append(x)
+        i += 2 if pattern[i] == '\\' else 1
+    return ''.join(out)
 
 class CXExtractor(object):
     # 每个窗口包含的行数
@@ -10,6 +42,16 @@ class CXExtractor(object):
     # 当待抽取的网页正文中遇到成块的新闻标题未剔除时，只要增大此阈值即可
     # 阈值增大，准确率提升，召回率下降；值变小，噪声会大，但可以保证抽到只有一句话的正文
     default_threshold = 240
+    # 行数超过此值时用numpy计算窗口
+    numpy_min_lines = 2000
+    # 每次extract后用profiling.Profile调用, None为不记录
+    profiler = None
+    # extract()结果的cache.ResultCache, None为不缓存
+    cache = None
+    # 每次extract的budget.Budget, None为不限制; CXExtractor不给块打分, 没有max_blocks
+    budget = None
+    # 给结果算simhash/minhash的fingerprint.Fingerprinter, None为不算
+    fingerprint = None
 
     _title = re.compile(r'<title>(.*?)</title>', re.I|re.S)
     _title2 = re.compile(r'<h1>(.*?)</h1>', re.I|re.S)
@@ -28,35 +70,47 @@ class CXExtractor(object):
                      (re.compile(r'&#62;', re.I|re.S), '>'),
                      (re.compile(r'&#160;', re.I|re.S), ' '),
                     ]
+    # preprocess用的同样的替换, 见fold_case
+    _special_fast = [(re.compile(fold_case(r.pattern), re.S), o) for r, o in _special_list]
     _special_char = re.compile(r'&\w{2,6};|&#\w{2,5};', re.I|re.S)
     # html
     _html = re.compile(r'<\w*html', re.I|re.S)
     # DTD
-    _doc_type = re.compile(r'<!DOCTYPE.*?>', re.I|re.S)
+    _doc_type = re.compile(fold_case(r'<!DOCTYPE.*?>'), re.S)
     # html annotation
-    _annotation = re.compile(r'<!--.*?-->', re.I|re.S)
+    _annotation = re.compile(fold_case(r'<!--.*?-->'), re.S)
     # js
-    _javascript = re.compile(r'<script[^>]*?>.*?</script>', re.I|re.S)
+    _javascript = re.compile(fold_case(r'<script[^>]*?>.*?</script>'), re.S)
     # css
-    _css = re.compile(r'<style[^>]*?>.*?</style>', re.I|re.S)
+    _css = re.compile(fold_case(r'<style[^>]*?>.*?</style>'), re.S)
     _ad_links = re.compile(r'(<a\s+[^>\"\']+href=[\"\']?[^>\"\']+[\"\']?\s+[^>]*>[^<>]{0,50}</a>\s*([^<>]{0,40}?)){2,100}', re.I|re.S) 
     _comment_links = re.compile(r'(<span[^>]*>[^<>]{0,50}</span>\s*([^<>]{0,40}?)){2,100}', re.I|re.S) 
-    _link = re.compile(r'<a.*?>|</a>', re.I|re.S)
-    _paragraph = re.compile(r'<p(\s+[^>]+)??>|</p>|<br>', re.I|re.S)
+    _link = re.compile(fold_case(r'<a.*?>|</a>'), re.S)
+    _paragraph = re.compile(fold_case(r'<p(\s+[^>]+)??>|</p>|<br>'), re.S)
     _special_tag = re.compile(r'<[^>\'\"]*[\'\"][^\'\"]{1,500}[\'\"][^>]*?>', re.I|re.S)
+    # 线性匹配_ad_links, _comment_links和_special_tag
+    _ad_start = re.compile(fold_case(r'<a\s'))
+    _span_start = re.compile(fold_case(r'<span'))
+    _href = re.compile(fold_case(r'href='))
+    _quote = re.compile(r'[\'\"]')
+    _tag_quote = re.compile(r'[>\'\"]')
+    _space = re.compile(r'\s')
+    _space_run = re.compile(r'\s*')
+    _angle = re.compile(r'[<>]')
     # tag
-    _other_tag = re.compile(r'<.*?>', re.I|re.S)
+    _other_tag = re.compile(fold_case(r'<.*?>'), re.S)
     _special_char = re.compile(r'&\w{2,6};|&#\w{2,5};', re.I|re.S)
     _new_line = re.compile(r'\r\n|\n\r|\r')
     _start_spaces = re.compile(r'^[ \t]+', re.M)
     _spaces = re.compile(r'[ \t]+')
     _multi = re.compile(r'\n|\r|\t')
+    _blank_lines = re.compile(r'\n\n+')
     _end = re.compile(r'(备\d+号)|(Copyright\s*©)|(版权所有)|(all rights reserved)', re.I)
 
 
     def preprocess(self, text):
         #如果正文被压缩到一行,替换时添加换行符
-        for r, o in self._special_list:
+        for r, o in self._special_fast:
             text = r.sub(o, text)
         s = self._html.search(text)
         if not s: return ''
@@ -69,11 +123,11 @@ class CXExtractor(object):
         text = self._annotation.sub(c, text)
         text = self._javascript.sub(c, text)
         text = self._css.sub(c, text)
-        text = self._ad_links.sub(c, text)
-        text = self._comment_links.sub(c, text)
+        text = self.remove_runs(text, c, self._ad_start, self.ad_link_end)
+        text = self.remove_runs(text, c, self._span_start, self.comment_link_end)
         text = self._link.sub(c, text)
         text = self._paragraph.sub('\n', text)
-        text = self._special_tag.sub('', text)
+        text = self.remove_special_tags(text)
         text = self._other_tag.sub('', text)
         text = self._special_char.sub(' ', text)
         text = self._new_line.sub('\n', text)
@@ -85,21 +139,184 @@ class CXExtractor(object):
         #print text
         return text
 
-    def get_blocks(self, lines, thres):
-        lens = [len(line) for line in lines]
-        # 去掉前后各有2个空行的短句
-        for i in range(len(lines) - 4):
-            if lens[i] == 0 and \
-               lens[i+1] == 0 and \
-               lens[i+2] > 0 and lens[i+2] < 2 and \
-               lens[i+3] == 0 and \
-               lens[i+4] == 0:
-                lens[i+2] = 0
+    def remove_runs(self, text, c, start, unit_end):
+        # 把2到100个连续的单元换成c, 与_ad_links和_comment_links的结果相同:
+        # 前两个单元之间除空白外最多40个字符, 之后的单元之间只能有空白
+        content = []
+        pos = 0
+        cache = {}
+        m = start.search(text)
+        while m:
+            p = m.start()
+            units, x, end = 0, p, p
+            while units < 100:
+                e = unit_end(text, x, cache)
+                if e < 0: break
+                units += 1
+                end = self._space_run.match(text, e).end()
+                j = self._angle.search(text, end, end + (41 if units == 1 else 1))
+                if not j or j.group() != '<': break
+                x = j.start()
+            if units >= 2:
+                content.append(text[pos:p])
+                content.append(c)
+                pos = end
+                m = start.search(text, end)
+            else:
+                m = start.search(text, p + 1)
+        content.append(text[pos:])
+        return ''.join(content)
+
+    def closing_end(self, text, q, close):
+        # [^<>]{0,50}后紧跟close
+        j = self._angle.search(text, q + 1, q + 52)
+        if not j or text[j.start():j.start()+len(close)].lower() != close: return -1
+        return j.start() + len(close)
+
+    def find_gt(self, text, i, cache):
+        # 上次找到的>之前的位置可以直接复用
+        start, q = cache.get('>', (0, -1))
+        if not start <= i <= q:
+            q = text.find('>', i)
+            if q < 0: q = len(text)
+            cache['>'] = (i, q)
+        return q if q < len(text) else -1
+
+    def comment_link_end(self, text, p, cache):
+        # <span[^>]*>[^<>]{0,50}</span>
+        if not self._span_start.match(text, p): return -1
+        q = self.find_gt(text, p + 5, cache)
+        if q < 0: return -1
+        return self.closing_end(text, q, '</span>')
+
+    def ad_link_end(self, text, p, cache):
+        # <a\s+[^>"']+href=["']?[^>"']+["']?\s+[^>]*>[^<>]{0,50}</a>
+        if not self._ad_start.match(text, p): return -1
+        q = self.find_gt(text, p + 2, cache)
+        if q < 0: return -1
+        # 先做便宜的</a>检查
+        end = self.closing_end(text, q, '</a>')
+        if end < 0: return -1
+        # 同一个标签内的引号, href=和空白的位置, 每个标签只找一次
+        if q not in cache:
+            cache[q] = [[m.start() for m in r.finditer(text, p, q)] for r in (self._quote, self._href, self._space)]
+        quotes, hrefs, spaces = cache[q]
+
+        def next_pos(positions, i, default):
+            k = bisect.bisect_left(positions, i)
+            return positions[k] if k < len(positions) else default
+
+        def value_ok(start, end):
+            # [^>"']+["']?\s+ 从start开始, end是之后第一个引号或>
+            if end <= start: return False
+            if next_pos(spaces, start + 1, q) < end: return True
+            return end < q and self._space.match(text, end + 1) is not None
+
+        # href=之前至少2个字符且没有引号
+        first_quote = next_pos(quotes, p + 2, q)
+        h = next_pos(hrefs, p + 4, q)
+        ok = False
+        if h + 5 < first_quote:
+            ok = value_ok(h + 5, first_quote)
+        # 或者href=后紧跟引号
+        h = first_quote - 5
+        if not ok and first_quote < q and h >= p + 4 and next_pos(hrefs, h, q) == h:
+            ok = value_ok(first_quote + 1, next_pos(quotes, first_quote + 1, q))
+        return end if ok else -1
+
+    def remove_special_tags(self, text):
+        # 去掉含引号的标签, 与_special_tag的结果相同
+        content = []
+        pos = 0
+        a = b = -1
+        gt = (0, -1)
+        i = text.find('<')
+        while i >= 0:
+            # 其后第一个>或引号, 接着是1到500个字符的引号内容
+            if a <= i:
+                m = self._tag_quote.search(text, i + 1)
+                a, b = (m.start() if m else len(text)), -1
+                if m and m.group() != '>':
+                    m = self._quote.search(text, a + 1, a + 502)
+                    if m and m.start() > a + 1: b = m.start()
+            if b > 0:
+                if not gt[0] <= b + 1 <= gt[1]:
+                    gt = (b + 1, text.find('>', b + 1))
+                    if gt[1] < 0: gt = (b + 1, len(text))
+                if gt[1] < len(text):
+                    content.append(text[pos:i])
+                    pos = gt[1] + 1
+                    i = text.find('<', pos)
+                    continue
+            i = text.find('<', i + 1)
+        content.append(text[pos:])
+        return ''.join(content)
+
+    def vectorize(self, tot_line):
+        return numpy is not None and tot_line > self.numpy_min_lines
 
+    def get_blocks(self, lines, thres):
+        if not lines: return []
+        if not isinstance(lines, LineIndex): lines = LineIndex('\n'.join(lines))
+        tot_line = len(lines)
+        if self.vectorize(tot_line):
+            lens = numpy.array(lines.lengths, dtype=numpy.int64)
+            # 去掉前后各有2个空行的短句
+            empty = lens == 0
+            m = tot_line - 4
+            if m > 0:
+                lens[2:m+2][empty[:m] & empty[1:m+1] & (lens[2:m+2] == 1) & empty[3:m+3] & empty[4:m+4]] = 0
+
+            sums = numpy.zeros(tot_line + 1, dtype=numpy.int64)
+            numpy.cumsum(lens, out=sums[1:])
+            ends = numpy.minimum(numpy.arange(self.block_width, tot_line + self.block_width), tot_line)
+            return (sums[ends] - sums[:-1]).tolist()
 
-        blocks = [sum(lens[i:i+self.block_width]) for i in range(len(lens))]
+        # 去掉前后各有2个空行的短句
+        lens = array('i', lines.lengths)
+        for i in xrange(2, tot_line - 2):
+            if lens[i] == 1 and not (lens[i-2] or lens[i-1] or lens[i+1] or lens[i+2]):
+                lens[i] = 0
+
+        sums = [0]
+        append = sums.append
+        n = 0
+        for v in lens:
+            n += v
+            append(n)
+        # 块宽度内的行长之和, 最后width-1块到文末为止
+        width = min(self.block_width, tot_line)
+        blocks = map(sub, sums[width:], sums[:tot_line-width+1])
+        blocks += [n - sums[i] for i in xrange(tot_line - width + 1, tot_line)]
         return blocks
 
+    def get_surges(self, blocks, thres):
+        # find_surge的所有候选位置: (首次匹配, 之后的匹配)
+        m = len(blocks) - 3
+        if m <= 0: return [], []
+        if self.vectorize(len(blocks)):
+            b = numpy.asarray(blocks)
+            pos = b > 0
+            near = pos[1:m+1] | pos[2:m+2]
+            surges = (b[:m] > thres) & (near | pos[3:m+3])
+            first_surges = surges | ((b[:m] > thres/2) & near)
+            return numpy.flatnonzero(first_surges).tolist(), numpy.flatnonzero(surges).tolist()
+
+        surges = [i for i in range(m) if blocks[i] > thres and \
+                  (blocks[i+1] > 0 or blocks[i+2] > 0 or blocks[i+3] > 0)]
+        first_surges = [i for i in range(m) if blocks[i] > thres/2 and \
+                        (blocks[i+1] > 0 or blocks[i+2] > 0) or \
+                        blocks[i] > thres and blocks[i+3] > 0]
+        return first_surges, surges
+
+    def get_dives(self, blocks):
+        # find_dive的所有候选位置
+        m = len(blocks) - 1
+        if self.vectorize(len(blocks)):
+            b = numpy.asarray(blocks) == 0
+            return numpy.flatnonzero(b[:m] | b[1:]).tolist()
+        return [i for i in range(m) if blocks[i] == 0 or blocks[i+1] == 0]
+
     def find_surge(self, blocks, end_i, thres, is_first_match):
         for i in range(end_i, len(blocks)-3):  
             if is_first_match:
@@ -149,13 +366,24 @@ class CXExtractor(object):
         return ''
 
     def extract_content(self, text, thres):
-        lines = text.split('\n')
+        return self.extract_block(text, thres)[0]
+
+    def extract_block(self, text, thres, prof=None, usage=None):
+        # 正文及其所在的行区间(istart, iend)
+        if prof: t = time.time()
+        lines = LineIndex(text)
+        if usage: lines = usage.cut('lines', lines, usage.budget.max_lines)
         blocks = self.get_blocks(lines, thres)
+        if prof:
+            prof.stage('get_blocks', t, len(lines), len(blocks))
+            prof.count('lines', len(lines))
+            prof.count('blocks', len(blocks))
+            t = time.time()
 
-        num_empty = sum([1 if len(v)>0 else 0 for v in lines]) 
+        num_empty = len(lines) - lines.lengths.count(0)
         sum_blocks = sum(blocks)
         if sum_blocks == 0:
-            return ''
+            return '', None
 
         #print 'empty:', num_empty
         #print 'blocks:', len(blocks)
@@ -167,95 +395,124 @@ class CXExtractor(object):
 
         #print 'thres:', thres
 
+        first_surges, surges = self.get_surges(blocks, thres)
+        dives = self.get_dives(blocks)
+
         start_i, end_i = 0, 0
         is_first_match = True
-        content = ''
+        span = None
+        content = []
+        steps = 0
         while True:
-            start_i = self.find_surge(blocks, end_i+1, thres, is_first_match)
-            if start_i < 0: break
+            candidates = first_surges if is_first_match else surges
+            k = bisect.bisect_left(candidates, end_i+1)
+            if k == len(candidates): break
+            # 超出预算时保留已合并的部分
+            if usage and span and (usage.over('merge_steps', steps, usage.budget.max_merge_steps) or usage.expired()): break
+            steps += 1
+            if prof: prof.count('merge_steps')
+            start_i = candidates[k]
             if is_first_match: is_first_match = False
-            end_i = self.find_dive(blocks, start_i+1)
-
-            sub_content = '\n'.join([v for v in lines[start_i:end_i+1] if v])
-            content += sub_content + '\n'
+            k = bisect.bisect_left(dives, start_i+1)
+            end_i = dives[k] if k < len(dives) else len(blocks) - 1
+            span = (span[0] if span else start_i, end_i + 1)
+
+            # 去掉区间里的空行
+            sub_content = self._blank_lines.sub('\n', lines.join(start_i, end_i+1)).strip('\n')
+            content.append(sub_content)
+            content.append('\n')
             if end_i >= len(blocks)/2:
                 if self._end.search(sub_content):
                     break
-        return self._multi.sub(' ', content)
+        content = self._multi.sub(' ', ''.join(content))
+        if prof: prof.stage('merge', t, len(blocks), len(content))
+        return content, span
 
-    def extract(self, text, _thres=0):
-        if not text: return '', ''
+    def cache_config(self, site=None):
+        # 除了网页和阈值, 影响结果的设置
+        return '%r:%r' % (self.budget, self.fingerprint)
 
+    def extract(self, text, _thres=0):
+        if not text: return ExtractResult()
+        key = self.cache and self.cache.key(self, text, _thres or self.default_threshold)
+        if key:
+            result = self.cache.get(key)
+            if result is not None: return result
+        prof = self.profiler and profiling.Profile()
+        usage = self.budget and self.budget.start()
+        if usage: text = usage.cut('bytes', text, usage.budget.max_bytes)
+
+        if prof: t = time.time()
         _title = self.extract_title(text)
         _keywords = self.extract_keywords(text)
         _desc = self.extract_description(text)
+        if prof:
+            prof.stage('metadata', t, len(text), len(_title) + len(_keywords) + len(_desc))
+            t = time.time()
+        raw_len = len(text)
         text = self.preprocess(text)
-        _content = self.extract_content(text, _thres or self.default_threshold)
-        return [_title, _content, _keywords, _desc]
+        if prof: prof.stage('preprocess', t, raw_len, len(text))
+        _content, _span = self.extract_block(text, _thres or self.default_threshold, prof, usage)
+        result = ExtractResult(_title, _content, _keywords, _desc, _span, degraded=usage and usage.degraded())
+        if self.fingerprint:
+            if prof: t = time.time()
+            self.fingerprint.fill(result)
+            if prof: prof.stage('fingerprint', t, len(_content))
+        if prof:
+            if result.degraded: prof.count('degraded')
+            self.profiler(prof)
+        # 降级的结果取决于预算和时间, 不缓存
+        if key and not result.degraded: self.cache.put(key, result)
+        return result
+
+    def extract_many(self, texts, workers=None, chunksize=16, ordered=True, _thres=0):
+        return batch.extract_many(self.__class__, texts, workers, chunksize, ordered, _thres, batch.settings(self))
+
+    def extract_archive(self, path, workers=None, shard=None, ordered=True, _thres=0):
+        return archive.extract_archive(self.__class__, path, workers, shard, ordered=ordered, thres=_thres,
+                                       settings=batch.settings(self))
 
 def download_and_normalize(url):
-    raw_html = urllib.urlopen(url).read()
-    if not raw_html:
-        return ''
-    best_match = ('', 0)
-    for charset in ['utf-8', 'gbk', 'big5', 'gb18030']:
-        try:
-            unicode_html = raw_html.decode(charset, 'ignore')
-            guess_html = unicode_html.encode(charset)
-            if len(guess_html) == len(raw_html):
-                best_match = (charset, len(guess_html))
-                break
-            elif len(guess_html) > best_match[1]:
-                best_match = (charset, len(guess_html))
-        except: 
-            pass
-    raw_html = raw_html.decode(best_match[0], 'ignore').encode('utf-8')
-    return raw_html
+    return fetch.download_and_normalize(url)
 
 def test():
+    # the saved pages in corpus/, see benchmark.py for the full suite
+    import benchmark
     ext = CXExtractor()
 
-    urls = [
-        'http://baike.baidu.com/view/25215.htm',
-        'http://tieba.baidu.com/p/3069273254',
-        'http://hi.baidu.com/handylee/blog/item/6523c4fc35a235fffc037fc5.html',
-        'http://xiezuoshi.baijia.baidu.com/article/15330',
-        'http://www.techweb.com.cn/news/2010-08-11/659082.shtml',
-        'http://www.ifanr.com/15876',
-        'http://news.cnhubei.com/xw/yl/201404/t2894467_5.shtml',
-        ]
-
-    for url in urls:
-        raw_html = download_and_normalize(url)
-        if raw_html:
-            print 'url:', url
-            start_time = time.time()
-            for i in xrange(0, 10):
-                title, content, keywords, desc= ext.extract(raw_html)
-            end_time = time.time()
-            print 'QPS:', 10/ (end_time-start_time) 
-            print 'title:', title
-            print 'content:', content
-        else:
-            print 'url:', url
-
-
-def test_file(p_in):
-    ext = CXExtractor()
-    for url in open(p_in):
-        url = url.strip()
-        if not url: continue
-        raw_html = download_and_normalize(url)
-        if raw_html:
-            print '\nurl:', url
-            title, content, keywords, desc = ext.extract(raw_html)
-            print 'title:', title
-            print 'content:', content
+    for name, raw_html in benchmark.load_corpus():
+        print 'page:', name
+        start_time = time.time()
+        for i in xrange(0, 10):
+            title, content, keywords, desc= ext.extract(raw_html)
+        end_time = time.time()
+        print 'QPS:', 10/ (end_time-start_time) 
+        print 'title:', title
+        print 'content:', content
+
+
+def test_file(p_in, cache_path=None):
+    urls = (url.strip() for url in open(p_in))
+    urls = (url for url in urls if url)
+    result_cache = cache_path and cache.ResultCache(path=cache_path)
+    for url, result, err in fetch.fetch_and_extract(CXExtractor, urls, settings={'cache': result_cache}):
+        print '\nurl:', url
+        if err:
+            print 'error_msg:', err
+            continue
+        title, content, keywords, desc = result
+        print 'title:', title
+        print 'content:', content
+    if result_cache:
+        print '\ncache:', result_cache.stats()
+        result_cache.close()
 
 if __name__ == '__main__':
     import sys
     if len(sys.argv)==2:
         test_file(sys.argv[1])
+    elif len(sys.argv)==3:
+        test_file(sys.argv[1], sys.argv[2])
     else:
         test()
 
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#coding: utf-8
+import re
+import sys
+import Queue
+import codecs
+import socket
+import httplib
+import urlparse
+import threading
+import traceback
+import multiprocessing
+import batch
+
+# fetch and extract pipeline
+# 1. a feeder thread queues the urls
+# 2. fetcher threads download them over keep-alive connections, at most
+#    per_host at once for a host
+# 3. a process pool normalizes and extracts the bodies
+# the queues between the stages are bounded, a slow stage blocks the one before
+
+class FetchError(Exception):
+    pass
+
+class ConnectionPool(object):
+    # idle keep-alive connections by (scheme, host, port)
+    def __init__(self, per_host=4, timeout=10):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.per_host)
+            return self.slots[key]
+
+    def get(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns: return conns.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def put(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns: conn.close()
+            self.idle = {}
+
+class Fetcher(object):
+    max_redirects = 5
+    headers = {'User-Agent': 'Mozilla/5.0 (compatible; sf-extractor)', 'Connection': 'keep-alive'}
+
+    def __init__(self, per_host=4, timeout=10, max_size=8 << 20):
+        self.pool = ConnectionPool(per_host, timeout)
+        self.max_size = max_size
+
+    def fetch(self, url):
+        # (body, content-type header) of the url, following redirects
+        for i in xrange(self.max_redirects + 1):
+            status, location, body, content_type = self.request(url)
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status != 200:
+                raise FetchError('HTTP %d: %s' % (status, url))
+            return body, content_type
+        raise FetchError('too many redirects: %s' % url)
+
+    def request(self, url):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise FetchError('bad url: %s' % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+
+        slot = self.pool.slot(key)
+        with slot:
+            while True:
+                conn, reused = self.pool.get(key)
+                try:
+                    conn.request('GET', path, headers=self.headers)
+                    resp = conn.getresponse()
+                    body = resp.read(self.max_size + 1)
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    # the server may have dropped an idle connection
+                    if reused: continue
+                    raise FetchError('%s: %s' % (e.__class__.__name__, url))
+                break
+            if len(body) > self.max_size:
+                conn.close()
+                raise FetchError('larger than %d bytes: %s' % (self.max_size, url))
+            if resp.will_close:
+                conn.close()
+            else:
+                self.pool.put(key, conn)
+        return resp.status, resp.getheader('location'), body, resp.getheader('content-type', '')
+
+    def close(self):
+        self.pool.close()
+
+# charsets tried in order when a page declares none that fits
+charsets = ['utf-8', 'gbk', 'big5', 'gb18030']
+# bytes validated against a charset, from the first non-ascii byte
+sample_size = 1 << 16
+# bytes searched for a <meta> charset declaration
+meta_size = 1 << 13
+_charset = re.compile(r'charset\s*=\s*[\"\']?([\w.:-]+)', re.I)
+_meta_charset = re.compile(r'<meta[^>]+?charset\s*=\s*[\"\']?([\w.:-]+)', re.I)
+_non_ascii = re.compile(r'[\x80-\xff]')
+# server defaults that say nothing about chinese pages
+_ignored_charsets = set(['ascii', 'iso8859-1', 'cp1252'])
+_charset_alias = {'gb2312': 'gbk'}
+
+def lookup_charset(name):
+    try:
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    if name in _ignored_charsets: return None
+    return _charset_alias.get(name, name)
+
+def is_valid(sample, charset, final):
+    try:
+        codecs.getincrementaldecoder(charset)('strict').decode(sample, final)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def get_charset(raw_html, content_type=''):
+    # declared charsets first, then the fallback order, each checked on
+    # a bounded sample instead of transcoding the whole page
+    m = _non_ascii.search(raw_html)
+    start = m.start() if m else len(raw_html)
+    sample = raw_html[start:start+sample_size]
+    final = start + sample_size >= len(raw_html)
+
+    declared = []
+    for r, text in ((_charset, content_type or ''), (_meta_charset, raw_html[:meta_size])):
+        m = r.search(text)
+        if m: declared.append(m.group(1))
+    for name in declared:
+        charset = lookup_charset(name)
+        if charset and is_valid(sample, charset, final):
+            return charset
+    for charset in charsets:
+        if is_valid(sample, charset, final):
+            return charset
+
+    # nothing fits, keep the charset that drops the fewest bytes
+    best_match = (charsets[0], 0)
+    for charset in charsets:
+        guess_len = len(sample.decode(charset, 'ignore').encode(charset))
+        if guess_len > best_match[1]:
+            best_match = (charset, guess_len)
+    return best_match[0]
+
+def normalize(raw_html, content_type=''):
+    # guess the charset and return utf-8
+    if not raw_html:
+        return ''
+    charset = get_charset(raw_html, content_type)
+    return raw_html.decode(charset, 'ignore').encode('utf-8')
+
+def download_and_normalize(url, timeout=10):
+    fetcher = Fetcher(timeout=timeout)
+    try:
+        return normalize(*fetcher.fetch(url))
+    finally:
+        fetcher.close()
+
+def _normalize_and_extract(task):
+    url, body, content_type, thres = task
+    try:
+        return url, batch._extractor.extract(normalize(body, content_type), thres), ''
+    except Exception:
+        return url, None, traceback.format_exc()
+
+def _put(queue, item, stop):
+    # False once the consumer is gone and nobody will take item
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _feed(urls, url_queue, fetchers, failure, stop):
+    # the fetchers are stopped even if urls raises, its exception is
+    # kept in failure for the consumer
+    try:
+        for url in urls:
+            if not _put(url_queue, url, stop): return
+    except Exception:
+        failure.append(sys.exc_info())
+    finally:
+        for i in xrange(fetchers):
+            _put(url_queue, None, stop)
+
+def _fetch(fetcher, url_queue, body_queue, stop):
+    while not stop.is_set():
+        try:
+            url = url_queue.get(timeout=0.1)
+        except Queue.Empty:
+            continue
+        if url is None: break
+        try:
+            body, content_type = fetcher.fetch(url)
+            item = (url, body, content_type, '')
+        except Exception as e:
+            item = (url, None, None, '%s: %s' % (e.__class__.__name__, e))
+        if not _put(body_queue, item, stop): return
+    _put(body_queue, None, stop)
+
+def fetch_and_extract(cls, urls, fetchers=16, workers=None, per_host=4,
+                      timeout=10, max_size=8 << 20, queue_size=64, thres=0, settings=None):
+    # yield (url, ExtractResult, err) as pages are fetched and extracted,
+    # err is the fetch error or the traceback of a failed extraction
+    # an exception raised by urls is raised again once the urls before it
+    # are handed back
+    # closing the generator early stops the threads, once their running
+    # fetches are done
+    fetcher = Fetcher(per_host, timeout, max_size)
+    url_queue = Queue.Queue(fetchers * 2)
+    body_queue = Queue.Queue(queue_size)
+    failure = []
+    stop = threading.Event()
+    threads = [threading.Thread(target=_feed, args=(urls, url_queue, fetchers, failure, stop))]
+    threads += [threading.Thread(target=_fetch, args=(fetcher, url_queue, body_queue, stop)) for i in xrange(fetchers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        batch._init_worker(cls, settings)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, batch._init_worker, (cls, settings))
+    pending = []
+    try:
+        running = fetchers
+        while running or pending:
+            # hand back finished pages, and wait for them once the pool
+            # has enough work or there is nothing left to fetch
+            # always with a timeout, an untimed get() ignores Ctrl-C
+            if pending and (pending[0].ready() or len(pending) >= workers * 2 or not running):
+                try:
+                    item = pending[0].get(0.1)
+                except multiprocessing.TimeoutError:
+                    continue
+                pending.pop(0)
+                yield batch._count(item, settings)
+                continue
+            try:
+                item = body_queue.get(timeout=0.05 if pending else 1)
+            except Queue.Empty:
+                continue
+            if item is None:
+                running -= 1
+                continue
+            url, body, content_type, err = item
+            if err:
+                yield url, None, err
+            elif pool is None:
+                yield _normalize_and_extract((url, body, content_type, thres))
+            else:
+                task = (_normalize_and_extract, (url, body, content_type, thres))
+                pending.append(pool.apply_async(batch._run, (task,)))
+        if pool is not None: pool.close()
+        if failure:
+            exc_type, exc, tb = failure[0]
+            raise exc_type, exc, tb
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        fetcher.close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#coding: utf-8
+import random
+import struct
+from collections import defaultdict
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# near-duplicate fingerprints of the extracted content
+# set extractor.fingerprint to a Fingerprinter and every result gets the
+# simhash and minhash of its content:
+#   simhash  a 64-bit int, near-duplicate contents differ in few bits
+#   minhash  a tuple of perms ints, the share of equal positions of two
+#            tuples estimates the jaccard similarity of the contents
+# the content's utf-8 bytes, their whitespace runs collapsed, are cut into
+# shingles of shingle bytes starting at each character, found from the
+# bytes without decoding them, so languages written without spaces shingle
+# the same way (8 bytes are 2 to 3 CJK characters), and each shingle is
+# hashed once for both
+# fill() hashes the content right after the extractor has assembled it,
+# before the result is built and cached; a result comes out of a cache
+# with its fingerprints, the extractors' cache keys include the
+# Fingerprinter's settings
+# shingles are hashed with a polynomial of their bytes mod 2 ** 64, the
+# same in every process and run, with numpy k vector steps for the whole
+# content
+
+MASK = (1 << 64) - 1
+# the shingle polynomial's base, the 64-bit FNV prime
+BASE = 1099511628211
+# minhash permutations (a * x + b) % PRIME of 32-bit hashes, a and b below
+# 2 ** 32 so that numpy computes them in uint64 without overflow
+PRIME = 4294967311
+# the bytes with bit b set, by b
+BIT_BYTES = [''.join(chr(c) for c in xrange(256) if c >> b & 1) for b in xrange(8)]
+
+class Fingerprinter(object):
+    def __init__(self, simhash=True, perms=0, shingle=8, seed=1):
+        # perms: minhash length, 0 for no minhash
+        self.simhash = simhash
+        self.shingle = shingle
+        self.seed = seed
+        rand = random.Random(seed)
+        self.perms = [(rand.randint(1, (1 << 32) - 1), rand.randint(0, (1 << 32) - 1)) for _ in xrange(perms)]
+
+    def __repr__(self):
+        # the settings, for cache keys
+        return 'Fingerprinter(simhash=%r, perms=%d, shingle=%d, seed=%r)' % \
+               (self.simhash, len(self.perms), self.shingle, self.seed)
+
+    def hashes(self, content):
+        # the mixed hashes of the shingles, an array with numpy
+        text = ' '.join(content.split())
+        k = min(self.shingle, len(text))
+        if not k: return []
+        n = len(text) - k + 1
+        if numpy is not None:
+            b = numpy.frombuffer(text, dtype=numpy.uint8).astype(numpy.uint64)
+            h = numpy.zeros(n, dtype=numpy.uint64)
+            base = numpy.uint64(BASE)
+            for j in xrange(k):
+                h = h * base + b[j:j+n]
+            return mix_array(h[(b[:n] & numpy.uint64(0xc0)) != numpy.uint64(0x80)])
+        # rolled from one shingle to the next
+        b = bytearray(text)
+        top = pow(BASE, k - 1, 1 << 64)
+        h = 0
+        for j in xrange(k):
+            h = (h * BASE + b[j]) & MASK
+        hashes = [mix(h)] if b[0] & 0xc0 != 0x80 else []
+        for i in xrange(k, len(b)):
+            h = ((h - b[i-k] * top) * BASE + b[i]) & MASK
+            if b[i-k+1] & 0xc0 != 0x80: hashes.append(mix(h))
+        return hashes
+
+    def fill(self, result):
+        # set result.simhash and result.minhash from its content
+        result.simhash = result.minhash = None
+        hashes = self.hashes(result.content)
+        if not len(hashes): return result
+        if self.simhash: result.simhash = simhash(hashes)
+        if self.perms: result.minhash = minhash(hashes, self.perms)
+        return result
+
+def mix(h):
+    # the 64-bit finalizer of murmur3, so that every bit of a shingle's
+    # polynomial depends on all of its bytes
+    h ^= h >> 33
+    h = h * 0xff51afd7ed558ccd & MASK
+    h ^= h >> 33
+    h = h * 0xc4ceb9fe1a85ec53 & MASK
+    return h ^ h >> 33
+
+def mix_array(h):
+    s = numpy.uint64(33)
+    h = h ^ (h >> s)
+    h *= numpy.uint64(0xff51afd7ed558ccd)
+    h ^= h >> s
+    h *= numpy.uint64(0xc4ceb9fe1a85ec53)
+    return h ^ (h >> s)
+
+def simhash(hashes):
+    # bit b is set when it is set in more than half of the hashes
+    if numpy is not None and isinstance(hashes, numpy.ndarray):
+        bits = numpy.unpackbits(hashes.astype('<u8').view(numpy.uint8).reshape(-1, 8), axis=1)
+        votes = bits.sum(axis=0) * 2 > len(hashes)
+        return int(numpy.packbits(votes).view('<u8')[0])
+    # the hashes packed little-endian, the bytes of each byte position
+    # sliced out, the bytes with a bit set deleted to count them
+    data = struct.pack('<%dQ' % len(hashes), *hashes)
+    v = 0
+    for i in xrange(8):
+        column = data[i::8]
+        for b in xrange(8):
+            if (len(column) - len(column.translate(None, BIT_BYTES[b]))) * 2 > len(hashes):
+                v |= 1 << (8 * i + b)
+    return v
+
+def minhash(hashes, perms):
+    if numpy is not None and isinstance(hashes, numpy.ndarray):
+        x = hashes & numpy.uint64(0xffffffff)
+        p = numpy.uint64(PRIME)
+        return tuple(int(((numpy.uint64(a) * x + numpy.uint64(b)) % p).min()) for a, b in perms)
+    xs = set(h & 0xffffffff for h in hashes)
+    return tuple(min((a * x + b) % PRIME for x in xs) for a, b in perms)
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def similarity(a, b):
+    # estimated jaccard similarity of two minhashes
+    return sum(1 for x, y in zip(a, b) if x == y) / float(len(a))
+
+class DuplicateIndex(object):
+    # the simhashes added so far, in max_distance + 1 tables by one band of
+    # their bits: two simhashes within max_distance bits agree on a band
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        n = max_distance + 1
+        self.bands = [(64 * i / n, (1 << 64 * (i + 1) / n - 64 * i / n) - 1) for i in xrange(n)]
+        self.tables = [defaultdict(list) for _ in self.bands]
+
+    def add(self, key, simhash):
+        # [(key, distance)] of the simhashes added before within max_distance
+        found = {}
+        for (shift, mask), table in zip(self.bands, self.tables):
+            bucket = table[simhash >> shift & mask]
+            for k, h in bucket:
+                if k not in found:
+                    d = hamming(simhash, h)
+                    if d <= self.max_distance: found[k] = d
+            bucket.append((key, simhash))
+        return sorted(found.iteritems())
+
+def near_duplicates(results, max_distance=3, min_similarity=None):
+    # yield (j, i, distance) for each near-duplicate pair among the
+    # (i, result, err) of an extract_many or extract_archive run, j the
+    # one seen first; with min_similarity, pairs must also have minhashes
+    # at least that similar
+    index = DuplicateIndex(max_distance)
+    minhashes = {}
+    for i, result, err in results:
+        if result is None or result.simhash is None: continue
+        if min_similarity is not None: minhashes[i] = result.minhash
+        for j, d in index.add(i, result.simhash):
+            if min_similarity is not None and \
+               (not minhashes[i] or not minhashes[j] or similarity(minhashes[i], minhashes[j]) < min_similarity):
+                continue
+            yield j, i, d
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#coding: utf-8
+import os
+import time
+import marshal
+import sqlite3
+import difflib
+import threading
+from array import array
+from collections import OrderedDict
+
+# the last version of each page, so that a re-crawled page only has the
+# lines that changed counted again
+# a PageState keeps the hashes and features (what stat_lines counts in a
+# line) of the page's non-empty lines, and the densities of its blocks;
+# the next version's lines are diffed against the hashes, the features of
+# the unchanged lines are copied, and a block whose lines did not change
+# keeps its densities, wherever it moved, and only has its position
+# scored again
+# a store is anything with get(key) and put(key, state): MemoryStore keeps
+# the states of the last size pages, SqliteStore the same in a sqlite file
+# shared by processes and kept between runs
+# lines are hashed with hash(), a state kept in sqlite only matches lines
+# for processes started with the same PYTHONHASHSEED (none by default)
+
+class PageState(object):
+    __slots__ = ('language', 'title', 'tot_line', 'lines', 'hashes', 'features', 'blocks', 'match', 'moved', 'kept')
+
+    def __init__(self, language, title, tot_line, lines=None, hashes=None, features=None, blocks=None):
+        self.language = language
+        self.title = title
+        self.tot_line = tot_line
+        # line numbers and hashes of the non-empty lines, and their features
+        self.lines = lines if lines is not None else array('I')
+        self.hashes = hashes if hashes is not None else array('l')
+        self.features = features if features is not None else []
+        # (istart, iend) -> (non-empty lines, split stop words, densities)
+        self.blocks = blocks if blocks is not None else {}
+        # while the page is scored: each line's index in previous or -1,
+        # moved[k] how many of the lines 1..k-1 are new or moved apart
+        # from the line before, and the number of lines found
+        self.match = None
+        self.moved = None
+        self.kept = 0
+
+    def follows(self, previous):
+        # features were counted the same way
+        return previous.language == self.language and previous.title == self.title
+
+    def diff(self, previous):
+        a, b = previous.hashes, self.hashes
+        match = [-1] * len(b)
+        # the diff only sees what is between the common head and tail
+        n = min(len(a), len(b))
+        head = 0
+        while head < n and a[head] == b[head]: head += 1
+        tail = 0
+        while tail < n - head and a[len(a)-1-tail] == b[len(b)-1-tail]: tail += 1
+        match[:head] = xrange(head)
+        match[len(b)-tail:] = xrange(len(a) - tail, len(a))
+        matcher = difflib.SequenceMatcher(None, a[head:len(a)-tail], b[head:len(b)-tail])
+        for j, k, size in matcher.get_matching_blocks():
+            match[head+k:head+k+size] = xrange(head + j, head + j + size)
+        self.kept = len(b) - match.count(-1)
+
+        moved = array('I', [0, 0])
+        old, new = previous.lines, self.lines
+        n = 0
+        for k in xrange(1, len(match)):
+            j = match[k]
+            if j <= 0 or j != match[k-1] + 1 or new[k] - old[j] != new[k-1] - old[j-1]: n += 1
+            moved.append(n)
+        self.match, self.moved = match, moved
+        return match
+
+    def kept_densities(self, previous, block, a, b, pairs):
+        # the densities of block, lines[a:b] of the page, if its lines were
+        # a block of previous too
+        if a >= b or self.match[a] < 0 or self.moved[b] != self.moved[a+1]: return None
+        shift = self.lines[a] - previous.lines[self.match[a]]
+        kept = previous.blocks.get((block[0] - shift, block[1] - shift))
+        if kept is None or kept[0] != b - a or kept[1] != pairs: return None
+        return kept[2]
+
+    def done(self):
+        # drop what only scoring the page needed
+        self.match = self.moved = None
+
+    def __getstate__(self):
+        return (self.language, self.title, self.tot_line, self.lines.tostring(),
+                self.hashes.tostring(), self.features, self.blocks)
+
+    def __setstate__(self, state):
+        language, title, tot_line, lines, hashes, features, blocks = state
+        self.__init__(language, title, tot_line, array('I', lines), array('l', hashes), features, blocks)
+
+class MemoryStore(object):
+    def __init__(self, size=1000):
+        self.size = size
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            state = self.states.pop(key, None)
+            if state is None:
+                self.misses += 1
+                return None
+            self.states[key] = state
+            self.hits += 1
+            return state
+
+    def put(self, key, state):
+        with self.lock:
+            self.states.pop(key, None)
+            self.states[key] = state
+            if len(self.states) > self.size:
+                self.states.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self.states)}
+
+class SqliteStore(object):
+    # the states of the size pages put last; the file grows to size +
+    # margin states before the oldest are evicted, in one query
+    def __init__(self, path, size=100000):
+        self.path = path
+        self.size = size
+        self.margin = max(1, size / 10)
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        self.pid = None
+
+    def db(self):
+        # one connection per process, a forked worker opens its own
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, used REAL, value BLOB)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS states_used ON states (used)')
+            self.conn.commit()
+            self.rows = self.conn.execute('SELECT COUNT(*) FROM states').fetchone()[0]
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            row = self.db().execute('SELECT value FROM states WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        state = PageState.__new__(PageState)
+        state.__setstate__(marshal.loads(str(row[0])))
+        return state
+
+    def put(self, key, state):
+        value = sqlite3.Binary(marshal.dumps(state.__getstate__()))
+        with self.lock:
+            db = self.db()
+            db.execute('INSERT OR REPLACE INTO states VALUES (?, ?, ?)', (key, time.time(), value))
+            # counts replaced states too, and not the other processes' puts:
+            # the rows are counted again at each eviction
+            self.rows += 1
+            if self.rows > self.size + self.margin:
+                db.execute('DELETE FROM states WHERE key IN (SELECT key FROM states ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.size,))
+                self.rows = db.execute('SELECT COUNT(*) FROM states').fetchone()[0]
+            db.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.db().execute('SELECT COUNT(*) FROM states').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
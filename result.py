@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+class ExtractResult(object):
+    # what an extractor returns for one page
+    # span is the (istart, iend) line range of the content in the
+    # tag-stripped text, None when nothing was extracted or the content
+    # came from a marker rule
+    # route is the extractor a cascade.CascadeExtractor used, 'cx' or
+    # 'sf', and None outside a cascade
+    # degraded names the budget.Budget limits the page hit, None if none
+    # simhash and minhash are the content's fingerprint.Fingerprinter
+    # fingerprints, None when the extractor has none
+    # og maps the head's og: properties to their content and charset is
+    # the charset the head declares, '' if none; None from CXExtractor,
+    # which does not read them
+    __slots__ = ('title', 'content', 'keywords', 'description', 'span', 'route', 'degraded', 'simhash', 'minhash',
+                 'og', 'charset')
+
+    def __init__(self, title='', content='', keywords='', description='', span=None, route=None, degraded=None,
+                 simhash=None, minhash=None, og=None, charset=None):
+        self.title = title
+        self.content = content
+        self.keywords = keywords
+        self.description = description
+        self.span = span
+        self.route = route
+        self.degraded = degraded
+        self.simhash = simhash
+        self.minhash = minhash
+        self.og = og
+        self.charset = charset
+
+    def fields(self):
+        return (self.title, self.content, self.keywords, self.description)
+
+    # unpacks and indexes like the old [title, content, keywords, desc] list
+    def __iter__(self):
+        return iter(self.fields())
+
+    def __getitem__(self, i):
+        return self.fields()[i]
+
+    def __len__(self):
+        return 4
+
+    def __getstate__(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        # states pickled before og and charset keep their defaults
+        ExtractResult.__init__(self, *state)
+
+    def __eq__(self, other):
+        return isinstance(other, ExtractResult) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ExtractResult(title=%r, content=%r, keywords=%r, description=%r, span=%r, route=%r, degraded=%r, ' \
+               'simhash=%r, minhash=%r, og=%r, charset=%r)' % self.__getstate__()
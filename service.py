@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#coding: utf-8
+import time
+import zlib
+import json
+import urlparse
+import threading
+import traceback
+import collections
+import multiprocessing
+import SocketServer
+import BaseHTTPServer
+import batch
+import fetch
+import profiling
+from sf_extractor import SFExtractor
+
+# local http extraction service
+#   POST /extract[?thres=n]  the html as the body, raw or with
+#                            Content-Encoding gzip/deflate, a charset in
+#                            Content-Type if known; returns the result as json
+#   GET /metrics             request counts, qps, queue depth and latency
+#                            histograms as json
+# handler threads only admit requests and write responses, pages are
+# decompressed, normalized and extracted by a process pool started, and
+# its extractors built, with the server
+# at most workers + queue_size pages are admitted at once, a request over
+# that is answered 503 at once instead of waiting; a page keeps its place
+# until its worker is done with it, even after its request timed out
+
+class Overloaded(Exception):
+    pass
+
+class BadRequest(Exception):
+    pass
+
+class ExtractError(Exception):
+    pass
+
+class TooLarge(Exception):
+    pass
+
+def _extract(task):
+    # (ExtractResult, None, seconds), or (None, the error class, message)
+    body, encoding, content_type, thres, max_size = task
+    start_time = time.time()
+    if encoding in ('gzip', 'deflate'):
+        # inflated up to max_size, whatever the body expands to
+        try:
+            body = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS).decompress(body, max_size + 1)
+        except zlib.error as e:
+            return None, BadRequest, 'bad %s body: %s' % (encoding, e)
+        if len(body) > max_size:
+            return None, TooLarge, 'larger than %d bytes once decompressed' % max_size
+    try:
+        result = batch._extractor.extract(fetch.normalize(body, content_type), thres)
+    except Exception:
+        return None, ExtractError, traceback.format_exc()
+    return result, None, time.time() - start_time
+
+def result_json(result):
+    d = {}
+    for k in result.__slots__:
+        v = getattr(result, k)
+        d[k] = v.decode('utf-8', 'ignore') if isinstance(v, str) else v
+    return json.dumps(d)
+
+class ExtractService(object):
+    # the pool, the admission bound and the metrics, shared by the
+    # handler threads
+    qps_window = 10.0
+
+    def __init__(self, cls=SFExtractor, workers=None, queue_size=64, timeout=30, settings=None, max_size=8 << 20):
+        self.workers = workers or multiprocessing.cpu_count()
+        # bytes of a page, as sent and decompressed
+        self.max_size = max_size
+        self.queue_size = queue_size
+        self.timeout = timeout
+        # the workers' counts and profiles go back to these settings'
+        self.settings = settings
+        self.pool = multiprocessing.Pool(self.workers, batch._init_worker, (cls, settings))
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.pending = 0
+        self.counts = {'requests': 0, 'ok': 0, 'bad_requests': 0, 'errors': 0, 'timeouts': 0, 'shed': 0}
+        self.done = collections.deque()
+        self.histograms = {'latency_ms': profiling.Histogram(), 'extract_ms': profiling.Histogram(),
+                           'queue_ms': profiling.Histogram(), 'bytes': profiling.Histogram()}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def release(self, _=None):
+        # a page left the pool
+        with self.lock:
+            self.pending -= 1
+
+    def finish(self, item):
+        # a page's batch._run item, counted even if its request timed out
+        self.release()
+        batch._count(item, self.settings)
+
+    def extract(self, body, encoding='', content_type='', thres=0):
+        with self.lock:
+            self.counts['requests'] += 1
+            if self.pending >= self.workers + self.queue_size:
+                self.counts['shed'] += 1
+                raise Overloaded()
+            self.pending += 1
+        start_time = time.time()
+        # _extract returns its errors, so the callback runs for every page
+        try:
+            task = self.pool.apply_async(batch._run, ((_extract, (body, encoding, content_type, thres, self.max_size)),),
+                                         callback=self.finish)
+        except Exception:
+            self.release()
+            raise
+        try:
+            result, error, value = task.get(self.timeout)[0]
+        except multiprocessing.TimeoutError:
+            self.count('timeouts')
+            raise
+        if error is not None:
+            self.count('errors' if error is ExtractError else 'bad_requests')
+            raise error(value)
+        now, seconds = time.time(), value
+        with self.lock:
+            self.counts['ok'] += 1
+            self.done.append(now)
+            self.histograms['latency_ms'].add((now - start_time) * 1000)
+            self.histograms['extract_ms'].add(seconds * 1000)
+            self.histograms['queue_ms'].add(max(0.0, now - start_time - seconds) * 1000)
+            self.histograms['bytes'].add(len(body))
+        return result
+
+    def metrics(self):
+        now = time.time()
+        with self.lock:
+            while self.done and self.done[0] < now - self.qps_window:
+                self.done.popleft()
+            metrics = dict(self.counts)
+            metrics.update({
+                'uptime_s': now - self.start_time,
+                'qps': len(self.done) / min(self.qps_window, max(now - self.start_time, 1e-3)),
+                'workers': self.workers,
+                'in_flight': self.pending,
+                'queue_depth': max(0, self.pending - self.workers),
+                'queue_size': self.queue_size,
+            })
+            for k, h in self.histograms.iteritems():
+                metrics[k] = dict(h.to_dict(), p50=h.percentile(50), p99=h.percentile(99))
+        return metrics
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class ExtractHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'sf-extractor'
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, code, body, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, message, headers=()):
+        self.respond(code, json.dumps({'error': message}), headers)
+
+    def do_GET(self):
+        if urlparse.urlsplit(self.path).path == '/metrics':
+            self.respond(200, json.dumps(self.server.service.metrics(), sort_keys=True))
+        else:
+            self.error(404, 'not found')
+
+    def do_POST(self):
+        parts = urlparse.urlsplit(self.path)
+        if parts.path != '/extract':
+            return self.error(404, 'not found')
+        length = self.headers.getheader('content-length')
+        if length is None or not length.isdigit():
+            self.close_connection = 1
+            return self.error(411, 'Content-Length required')
+        if int(length) > self.server.service.max_size:
+            self.close_connection = 1
+            return self.error(413, 'larger than %d bytes' % self.server.service.max_size)
+        body = self.rfile.read(int(length))
+        encoding = (self.headers.getheader('content-encoding') or '').strip().lower()
+        if encoding not in ('', 'identity', 'gzip', 'deflate'):
+            return self.error(415, 'unsupported Content-Encoding: %s' % encoding)
+        try:
+            thres = int(urlparse.parse_qs(parts.query).get('thres', ['0'])[0])
+        except ValueError:
+            return self.error(400, 'bad thres')
+
+        try:
+            result = self.server.service.extract(body, encoding, self.headers.getheader('content-type') or '', thres)
+        except Overloaded:
+            return self.error(503, 'overloaded', [('Retry-After', '1')])
+        except multiprocessing.TimeoutError:
+            return self.error(504, 'extraction timed out')
+        except BadRequest as e:
+            return self.error(400, str(e))
+        except TooLarge as e:
+            return self.error(413, str(e))
+        except ExtractError as e:
+            return self.error(500, str(e))
+        self.respond(200, result_json(result))
+
+    def log_message(self, format, *args):
+        pass
+
+class ExtractServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ExtractHandler)
+        self.service = service
+
+def serve(port=8080, host='127.0.0.1', cls=SFExtractor, workers=None, queue_size=64, **kwargs):
+    # the started server, call serve_forever() on it; server.shutdown()
+    # and server.service.close() stop it
+    service = ExtractService(cls, workers, queue_size, **kwargs)
+    try:
+        return ExtractServer((host, port), service)
+    except Exception:
+        service.close()
+        raise
+
+if __name__ == '__main__':
+    # python service.py [port] [workers]
+    import sys
+    server = serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+                   workers=int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print 'listening on %s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.service.close()
@@ -3,8 +3,26 @@
 #author: zuotaoliu@126.com
 import re
 import math
+import mmap
+import hashlib
+import tempfile
+import bisect
 import time
-import urllib
+from array import array
+from itertools import compress
+import batch
+import cache
+import archive
+import fetch
+import profiling
+import languages
+import incremental
+from lineindex import LineIndex
+from result import ExtractResult
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # smooth and fast html extractor
 # 1. remove newline characters
@@ -17,14 +35,45 @@ import urllib
 class SFExtractor(object):
     # mininum size of a valid block
     min_block_len = 10
+    # vectorize block segmentation of pages with more lines than this
+    numpy_min_lines = 2000
+    # called with a profiling.Profile after each extract, None to disable
+    profiler = None
+    # a boilerplate.BoilerplateCache shared by the pages of each site,
+    # used when extract() is given the page's site
+    templates = None
+    # a cache.ResultCache of extract() results, None to disable
+    cache = None
+    # a markers.MarkerRegistry of sites marking their content, None to
+    # always use the statistics
+    markers = None
+    # a budget.Budget of each extract() call, None for no limits
+    budget = None
+    # the languages.LanguageProfile of the pages, by name
+    language = 'zh'
+    # an incremental store (incremental.MemoryStore or SqliteStore) of the
+    # last version of each page, used when extract() is given the page's
+    # url, None to always count every line
+    states = None
+    # a fingerprint.Fingerprinter setting each result's simhash and
+    # minhash, None for no fingerprints
+    fingerprint = None
 
     # meta data
     _title = re.compile(r'<title>(.*?)</title>', re.I|re.S)
     _title2 = re.compile(r'<h1>(.*?)</h1>', re.I|re.S)
     _description = re.compile(r'<\s*meta\s*name=\"?Description\"?\s+content=\"?(.*?)\"?\s*>', re.I|re.S)
     _keywords = re.compile(r'<\s*meta\s*name=\"?Keywords\"?\s+content=\"?(.*?)\"?\s*>', re.I|re.S)
-    # special cases
-    _annotation_cases = [re.compile(r'<!-- 正文开始 -->(.*?)<!-- 正文结束 -->'),]
+    # all of them in one pass over the head, skipping doctypes and comments
+    _head_meta = re.compile(r'<!DOCTYPE[^>]*?>|<!--.*?-->|(</head\s*>)|<title>(.*?)</title>|'
+                            r'<\s*meta\s*name=\"?Keywords\"?\s+content=\"?(.*?)\"?\s*>|'
+                            r'<\s*meta\s*name=\"?Description\"?\s+content=\"?(.*?)\"?\s*>|'
+                            r'(<meta\s[^>]*>)', re.I|re.S)
+    _meta_attr = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+    _meta_charset = re.compile(r'charset=([\w-]+)', re.I)
+    # bytes of the page read for meta data, and for a missing title
+    head_size = 1 << 17
+    title_size = 1 << 18
     # special chars
     _special_list = [(re.compile(r'&quot;', re.I|re.S), '\"'),
                      (re.compile(r'&amp;', re.I|re.S), '&'),
@@ -61,121 +110,431 @@ class SFExtractor(object):
     _spaces = re.compile(r'[ \t]+')
     #_multi = re.compile(r'\n+')
     _multi = re.compile(r'\n|\r|\t')
-    # punction
-    _punc = re.compile(r',|\?|!|:|;|。|，|？|！|：|；|《|》|%|、|“|”', re.I|re.S)
-    # stop words, specific for chinese pages
-    _stopword = re.compile(r'备\d+号|Copyright\s*©|版权所有|all rights reserved|广告|推广|回复|评论|关于我们|链接|About|广告|下载|href=|本网|言论|内容合作|法律法规|原创|许可证|营业执照|合作伙伴|备案', re.I|re.S)
+    # punctuation and stop words are counted by the languages profile
+    # the halves of a 'Copyright ©' split over lines
+    _stopword_tail = re.compile(r'Copyright\s*$', re.I)
+    _stopword_head = re.compile(r'\s*©')
+    # line flags: has text, ends with the first half, starts with the second
+    NONBLANK, TAIL, HEAD = 1, 2, 4
+
+    # single-pass scanner
+    # entities (and chains like &amp;lt; that the _special_list cascade decodes twice) and carriage returns
+    _entities = re.compile(r'&(?:(?:amp|#38);)*(?:\w{2,6};|#\w{2,5};)|\r\n|\n\r|\r', re.I)
+    _entity_map = dict((r.pattern, c) for r, c in _special_list)
+    # constructs, in the order the regex cascade used to remove them
+    DOCTYPE, COMMENT, SCRIPT, STYLE, LINK, TAG = range(1, 7)
+    _opener = re.compile(r'<(?:(!DOCTYPE)|(!--)|(script)|(style)|(a|/a>))?', re.I)
+    _replace = {DOCTYPE: '', COMMENT: '', SCRIPT: '\n', STYLE: '\n', LINK: _link_mark, TAG: '\n'}
+    # end of a construct, skipping the constructs removed before it
+    _seek_doctype = re.compile(r'(>)')
+    _seek_comment = re.compile(r'(-->)|<!DOCTYPE', re.I)
+    _seek_script_tag = re.compile(r'(>)|<!(?:DOCTYPE|--)', re.I)
+    _seek_script = re.compile(r'(</script>)|<!(?:DOCTYPE|--)', re.I)
+    _seek_style_tag = re.compile(r'(>)|<!(?:DOCTYPE|--)|<script', re.I)
+    _seek_style = re.compile(r'(</style>)|<!(?:DOCTYPE|--)|<script', re.I)
+    _seek_link = re.compile(r'(>)|<!(?:DOCTYPE|--)|<s(?:cript|tyle)', re.I)
+    _seek_tag = re.compile(r'(>)|<!(?:DOCTYPE|--)|<s(?:cript|tyle)|</?a', re.I)
+    _meta = re.compile(r'<!(?:DOCTYPE|--)', re.I)
+    # next '<', with plain tags and links that hold no other '<' matched in full
+    _next_tag = re.compile(r'<(?:(/a>|a[^<>]*>)|(?!!DOCTYPE|!--|script|style)[^<>]*>)?', re.I)
+    _lead_spaces = re.compile(r'\s*')
+
+
+    def decode_entity(self, match):
+        text = match.group()
+        if text[0] != '&': return ' '
+        c = self._entity_map.get(text.lower())
+        if c is not None: return c
+        if text.count(';') > 1:
+            for r, c in self._special_list:
+                text = r.sub(c, text)
+        return self._special_char.sub(' ', text)
+
+    def find(self, text, pos, stop, memo):
+        # stop.search(text, pos), reusing the last search of stop when pos
+        # lies between where it started and its match
+        last = memo.get(stop)
+        if last and last[0] <= pos and (last[1] is None or pos <= last[1].start()):
+            return last[1]
+        m = stop.search(text, pos)
+        memo[stop] = (pos, m)
+        return m
+
+    def seek(self, text, pos, stop, stage, final=True, memo=None):
+        # end of the first closer of stop from pos, skipping the constructs
+        # below stage. what follows a match of stop does not depend on where
+        # the search started, so the end each match led to is kept in memo
+        # (one per text) and an unclosed construct is searched through once,
+        # not once per opener before it
+        if memo is None: memo = {}
+        seen = []
+        while True:
+            m = self.find(text, pos, stop, memo)
+            if not m:
+                if not final: raise Incomplete()
+                end = -1
+                break
+            end = memo.get((stop, m.start()))
+            if end is not None: break
+            seen.append(m.start())
+            if m.lastindex:
+                end = m.end()
+                break
+            end = self.construct(text, m.start(), stage, final, memo)[1]
+            pos = end if end >= 0 else m.start() + 1
+        for i in seen: memo[(stop, i)] = end
+        return end
+
+    def construct_end(self, text, stage, i, final=True, memo=None):
+        if memo is None: memo = {}
+        end = memo.get((stage, i))
+        if end is not None: return end
+        if stage == self.DOCTYPE:
+            end = self.seek(text, i + 9, self._seek_doctype, stage, final, memo)
+        elif stage == self.COMMENT:
+            end = self.seek(text, i + 4, self._seek_comment, stage, final, memo)
+        elif stage == self.SCRIPT:
+            end = self.seek(text, i + 7, self._seek_script_tag, stage, final, memo)
+            if end >= 0: end = self.seek(text, end, self._seek_script, stage, final, memo)
+        elif stage == self.STYLE:
+            end = self.seek(text, i + 6, self._seek_style_tag, stage, final, memo)
+            if end >= 0: end = self.seek(text, end, self._seek_style, stage, final, memo)
+        elif stage == self.LINK and text[i+1] == '/':
+            end = i + 4
+        elif stage == self.LINK:
+            end = self.seek(text, i + 2, self._seek_link, stage, final, memo)
+        else:
+            end = self.seek(text, i + 1, self._seek_tag, stage, final, memo)
+        memo[(stage, i)] = end
+        return end
+
+    def construct(self, text, i, below, final=True, memo=None):
+        # (stage, end) of the construct starting at text[i] == '<',
+        # raises Incomplete if it may end beyond the text and not final
+        if memo is None: memo = {}
+        stage = self._opener.match(text, i).lastindex
+        if stage and stage < below:
+            end = self.construct_end(text, stage, i, final, memo)
+            if end >= 0: return stage, end
+        if self.TAG < below:
+            return self.TAG, self.construct_end(text, self.TAG, i, final, memo)
+        return None, -1
+
+    def search(self, regex, text):
+        # regex.search on the text without doctypes and comments
+        m = regex.search(text)
+        pos = 0
+        memo = {}
+        while m:
+            s = self._meta.search(text, pos, m.end())
+            if not s: return m
+            end = self.construct(text, s.start(), self.SCRIPT, memo=memo)[1]
+            if end < 0:
+                pos = s.start() + 1
+            elif end <= m.start():
+                pos = end
+            else:
+                return regex.search(self.uncomment(text))
+        return m
 
+    def uncomment(self, text):
+        if '<!' not in text: return text
+        text = self._doc_type.sub('', text)
+        return self._annotation.sub('', text)
+
+    def is_script(self, text):
+        # the page is a document.write snippet
+        pos = 0
+        memo = {}
+        while True:
+            pos = self._lead_spaces.match(text, pos).end()
+            end = self.construct(text, pos, self.SCRIPT, memo=memo)[1] if text.startswith('<!', pos) else -1
+            if end < 0: break
+            pos = end
+        return text.startswith('document.write', pos)
 
     def preprocess(self, text):
-        text = self._new_line.sub(' ', text)
-        #text = text.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '\"').replace('&amp;', '&').replace('&nbsp;', ' ')
-        for r, c in self._special_list:
-            text = r.sub(c, text)
-        text = self._special_char.sub(' ', text)
-        text = self._doc_type.sub('', text)
-        text = self._annotation.sub('', text)
-        s = self._html.search(text)
+        text = self._entities.sub(self.decode_entity, text)
+        s = self.search(self._html, text) or self._html.search(self.uncomment(text))
         if not s: return ''
-        if text.strip().startswith('document.write'): return ''
+        if self.is_script(text): return ''
         return text
 
+    def scan_tags(self, text, final=True):
+        # one pass over the text: drop doctype, comments, js and css,
+        # mark links and turn the other tags into newlines.
+        # returns the result for text[:end] and end, which is before the
+        # first construct that may end beyond the text when not final
+        # unlike the regex cascade, the text around a dropped doctype or
+        # comment is not joined: '<!-- a -<!DOCTYPE x>->' is no comment
+        content = []
+        pos = 0
+        memo = {}
+        m = self._next_tag.search(text)
+        while m:
+            i, end = m.span()
+            if end > i + 1:
+                stage = self.LINK if m.lastindex else self.TAG
+            else:
+                try:
+                    stage, end = self.construct(text, i, self.TAG + 1, final, memo)
+                except Incomplete:
+                    content.append(text[pos:i])
+                    return ''.join(content), i
+                if end < 0:
+                    m = self._next_tag.search(text, i + 1)
+                    continue
+            content.append(text[pos:i])
+            content.append(self._replace[stage])
+            pos = end
+            m = self._next_tag.search(text, pos)
+        content.append(text[pos:])
+        return ''.join(content), len(text)
+
     def remove_tags(self, text):
-        text = self._javascript.sub('\n', text)
-        text = self._css.sub('\n', text)
-        #text = self._ad_links.sub('\n', text)
-        #text = self._comment_links.sub('\n', text)
-        text = self._link.sub(self._link_mark, text)
-        #text = self._paragraph.sub('\n', text)
-        #text = self._special_tag.sub('\n', text)
-        text = self._other_tag.sub('\n', text)
-        #text = self._multi.sub('\n', text)
-
-        text = self._start_spaces.sub('', text)
-        text = self._spaces.sub(' ', text)
+        text = self._spaces.sub(' ', self.scan_tags(text)[0])
+        text = text.replace('\n ', '\n')
+        if text.startswith(' '): text = text[1:]
 
         #print 'after all'.center(100, '*')
         #print text
         return text
 
+    def normalize_line(self, line):
+        # remove_tags' space handling for a single line
+        line = self._spaces.sub(' ', line)
+        return line[1:] if line.startswith(' ') else line
+
+    def get_interval(self, line_lens):
+        # empty runs between non-empty lines
+        tot_line = len(line_lens)
+        if self.vectorize(tot_line):
+            lens = numpy.asarray(line_lens)
+            ends = numpy.flatnonzero(lens[1:]) + 1
+            runs = numpy.diff(numpy.concatenate(([0], ends))) - 1
+            last = int(ends[-1]) if len(ends) else 0
+            if tot_line - 1 > last:
+                runs = numpy.append(runs, tot_line - last - 2)
+            if not len(runs): return 0
+            # 20th percentile of the runs, a run of v lines weighted by v
+            runs.sort()
+            weights = numpy.cumsum(numpy.maximum(runs, 1))
+            return int(runs[numpy.searchsorted(weights, weights[-1] / 5, 'right')]) + 1
+
+        empty_blocks = {}
+        istart = 0
+        for iend in xrange(1, tot_line):
+            if line_lens[iend] != 0:
+                v = iend - istart - 1
+                empty_blocks[v] = empty_blocks.get(v, 0) + 1
+                istart = iend
+        if tot_line - 1 > istart:
+            v = tot_line - istart - 2
+            empty_blocks[v] = empty_blocks.get(v, 0) + 1
+        if not empty_blocks: return 0
+        weights = [(gap, count * max(gap, 1)) for gap, count in sorted(empty_blocks.items())]
+        k = sum(w for v, w in weights) / 5
+        for v, w in weights:
+            if k < w: return v + 1
+            k -= w
+
+    def vectorize(self, tot_line):
+        return numpy is not None and tot_line > self.numpy_min_lines
+
     def get_blocks(self, lines, thres):
         if not lines: return []
+        if not isinstance(lines, LineIndex): lines = LineIndex('\n'.join(lines))
         #for lin in lines:
         #    print len(lin), lin
-        line_lens = [len(line) for line in lines]
+        line_lens = lines.lengths
         tot_line = len(lines)
+        if self.vectorize(tot_line): line_lens = numpy.frombuffer(line_lens, dtype=numpy.int32)
 
         # get property block interval
-        empty_blocks = []
-        istart = 0
-        for iend in xrange(0, tot_line):
-            if line_lens[iend] != 0 and iend > istart:
-                empty_blocks.append( iend-istart-1 ) 
-                istart = iend
-            if iend == tot_line - 1 and iend > istart:
-                empty_blocks.append( iend-istart-1 ) 
-        if not empty_blocks: return []
-        sort_list = sorted(empty_blocks)
-        sort_list2 = []
-        for v in sort_list:
-            if v > 1: sort_list2.extend([v] * v)
-            else: sort_list2.append(v)
-        prop_interval = max(3, sort_list2[len(sort_list2)/5]+1) 
+        prop_interval = self.get_interval(line_lens)
+        if not prop_interval: return []
+        prop_interval = max(3, prop_interval)
         #print 'interval:', prop_interval
 
+        # prefix sums of line lengths, and the lines followed by an
+        # almost empty window of prop_interval lines
+        if self.vectorize(tot_line):
+            sums = numpy.zeros(tot_line + 1, dtype=numpy.int64)
+            numpy.cumsum(line_lens, out=sums[1:])
+            ends = numpy.minimum(numpy.arange(prop_interval, tot_line + prop_interval), tot_line)
+            gaps = numpy.flatnonzero(sums[ends] - sums[:-1] <= 3).tolist()
+            sums = sums.tolist()
+        else:
+            sums = [0] * (tot_line + 1)
+            for i, n in enumerate(line_lens):
+                sums[i+1] = sums[i] + n
+            gaps = [i for i in xrange(tot_line) if sums[min(i+prop_interval, tot_line)] - sums[i] <= 3]
+
         # get blocks 
         blocks = []
         istart = 0
-        for iend in xrange(0, tot_line):
-            if sum(line_lens[iend:iend+prop_interval]) <= 3 and iend > istart:
-                if sum(line_lens[istart:iend]) >= thres: 
+        for iend in gaps:
+            if iend > istart:
+                if sums[iend] - sums[istart] >= thres: 
                     blocks.append((istart, iend))
                 istart = iend + prop_interval
                 while istart < tot_line - 1 and line_lens[istart] <= 2:
                     istart += 1
-            if iend == tot_line - 1:
-                if sum(line_lens[istart:iend]) >= thres: 
-                    blocks.append((istart, iend))
+        iend = tot_line - 1
+        if (sums[iend] - sums[istart] if istart < iend else 0) >= thres: 
+            blocks.append((istart, iend))
         return blocks
 
-    def stat_blocks(self, lines, blocks):
-        title_set = set(self.title.decode('utf-8', 'ignore'))
-        title_len = len(title_set) + 1.0
+    def line_features(self, line, profile, title_set):
+        # (text length, punctuation, links, stop words, flags, title chars)
+        clean_line = line.replace(self._link_mark, '')
+        uline = clean_line.decode('utf-8', 'ignore')
+        flags = 0
+        if clean_line.strip():
+            flags = self.NONBLANK
+            if self._stopword_head.match(clean_line): flags |= self.HEAD
+            if self._stopword_tail.search(clean_line): flags |= self.TAIL
+        return (len(clean_line), profile.count_punc(uline), line.count(self._link_mark),
+                profile.count_stopwords(clean_line.lower().decode('utf-8', 'ignore')),
+                flags, tuple(set(uline) & title_set))
+
+    def stat_lines(self, lines, title='', state=None, previous=None):
+        # with an incremental.PageState, the lines' hashes and features are
+        # kept in it, and the features of the lines the previous state has
+        # too are copied instead of counted
+        title_set = set(title.decode('utf-8', 'ignore'))
+        profile = languages.get(self.language)
+        if not isinstance(lines, LineIndex): lines = LineIndex('\n'.join(lines))
+        text, offsets, lengths = lines.text, lines.offsets, lines.lengths
         tot_line = len(lines)
-
-        block_scores = []
-        for istart, iend in blocks:
-            block = '\n'.join(lines[istart:iend]) 
-            line_num = iend - istart + 1.0
-            clean_block = block.replace(self._link_mark, '')
-
-            position_rate = (tot_line - istart + 1.0) / (tot_line + 1.0)
-            text_density = (len(clean_block) + 1.0) / line_num 
-            punc_density = (len(self._punc.findall(clean_block)) + 1.0) / line_num 
-            link_density = (block.count(self._link_mark) + 1.0) / line_num 
-            stopword_density = (len(self._stopword.findall(clean_block)) + 1.0) / line_num 
-            matched_set = set(clean_block.decode('utf-8', 'ignore')) & title_set
-            title_match_rate = len(''.join(matched_set)) / title_len 
-
-            score = position_rate * text_density
-            score *= math.pow(punc_density, 0.5)
-            score *= 1.0 + title_match_rate
-            score /= link_density
-            score /= math.pow(stopword_density, 0.5)
-
-            block_scores.append(score)
-        return block_scores
+        stats = LineStats(tot_line, title_set)
+        # only the non-empty lines
+        nonempty = compress(xrange(tot_line), lengths)
+        match = None
+        if state is not None:
+            nonempty = state.lines = array('I', nonempty)
+            state.hashes = array('l', [hash(text[offsets[i]:offsets[i]+lengths[i]]) for i in nonempty])
+            if previous is not None: match = state.diff(previous)
+        line_features = self.line_features
+        kept = state.features if state is not None else None
+        text_len, punc, link, stopword = 0, 0, 0, 0
+        tail = -1
+        for k, i in enumerate(nonempty):
+            if match is not None and match[k] >= 0:
+                features = previous.features[match[k]]
+            else:
+                features = line_features(text[offsets[i]:offsets[i]+lengths[i]], profile, title_set)
+            if kept is not None: kept.append(features)
+            n, p, l, s, flags, chars = features
+            text_len += n
+            punc += p
+            link += l
+            stopword += s
+            if flags:
+                if tail >= 0 and flags & self.HEAD:
+                    stats.pair_tails.append(tail)
+                    stats.pair_heads.append(i)
+                tail = i if flags & self.TAIL else -1
+            for c in chars:
+                stats.title_lines[c].append(i)
+            stats.lines.append(i)
+            stats.text_len.append(text_len)
+            stats.punc.append(punc)
+            stats.link.append(link)
+            stats.stopword.append(stopword)
+        return stats
+
+    def score_block(self, stats, istart, iend):
+        return self.position_score(stats.tot_line, istart, self.block_densities(stats, istart, iend))
+
+    def block_densities(self, stats, istart, iend):
+        line_num = iend - istart + 1.0
+        a, b = stats.span(istart, iend)
+        text_len = stats.text_len[b] - stats.text_len[a]
+        if iend > istart: text_len += iend - istart - 1
+
+        text_density = (text_len + 1.0) / line_num 
+        punc_density = (stats.punc[b] - stats.punc[a] + 1.0) / line_num 
+        link_density = (stats.link[b] - stats.link[a] + 1.0) / line_num 
+        stopword_density = (stats.stopword[b] - stats.stopword[a] + stats.count_pairs(istart, iend) + 1.0) / line_num 
+        title_match_rate = stats.count_title(istart, iend) / stats.title_len 
+        return text_density, punc_density, link_density, stopword_density, title_match_rate
+
+    def position_score(self, tot_line, istart, densities):
+        text_density, punc_density, link_density, stopword_density, title_match_rate = densities
+        position_rate = (tot_line - istart + 1.0) / (tot_line + 1.0)
+        score = position_rate * text_density
+        score *= math.pow(punc_density, 0.5)
+        score *= 1.0 + title_match_rate
+        score /= link_density
+        score /= math.pow(stopword_density, 0.5)
+        return score
+
+    def rescore_block(self, stats, state, previous, block, prof=None):
+        # score_block, with the densities previous kept if the block's
+        # lines did not change
+        a, b = stats.span(*block)
+        pairs = stats.count_pairs(*block)
+        densities = previous and state.kept_densities(previous, block, a, b, pairs)
+        if densities is None:
+            densities = self.block_densities(stats, *block)
+        elif prof:
+            prof.count('kept_blocks')
+        state.blocks[block] = (b - a, pairs, densities)
+        return self.position_score(stats.tot_line, block[0], densities)
+
+    def stat_blocks(self, lines, blocks, title=''):
+        stats = self.stat_lines(lines, title)
+        return [self.score_block(stats, istart, iend) for istart, iend in blocks]
+
+    def extract_meta(self, text):
+        # title, keywords, description, og: properties and charset of
+        # the head, a title is only looked up in the body when missing
+        meta = {'title': None, 'keywords': None, 'description': None, 'og': {}, 'charset': ''}
+        head = text[:self.head_size]
+        fields = ('title', 'keywords', 'description')
+        for m in self._head_meta.finditer(head):
+            end, title, keywords, desc, tag = m.groups()
+            if end: break
+            if '<' in (tag or '')[1:] or '<' in (title or keywords or desc or ''):
+                # a tag inside another one, search each field like the
+                # full-page regexes did
+                for k, r in zip(fields, (self._title, self._keywords, self._description)):
+                    match = self.search(r, head)
+                    meta[k] = match.group(1) if match else None
+                break
+            for k, v in zip(fields, (title, keywords, desc)):
+                if v is not None and meta[k] is None: meta[k] = v
+            if tag:
+                attrs = dict((a.lower(), v or v2 or v3) for a, v, v2, v3 in self._meta_attr.findall(tag))
+                prop = attrs.get('property', attrs.get('name', '')).lower()
+                if prop.startswith('og:') and prop not in meta['og']:
+                    meta['og'][prop] = attrs.get('content', '')
+                if not meta['charset'] and 'charset' in attrs:
+                    meta['charset'] = attrs['charset']
+                elif not meta['charset']:
+                    charset = self._meta_charset.search(attrs.get('content', ''))
+                    if charset: meta['charset'] = charset.group(1)
+        if meta['title'] is None:
+            match = self.search(self._title, text[:self.title_size]) or self.search(self._title2, text[:self.title_size])
+            if match: meta['title'] = match.group(1)
+        for k in fields:
+            if meta[k] is not None: meta[k] = self._multi.sub(' ', meta[k])
+        meta['title'] = self.clean_title(meta['title'])
+        meta['keywords'] = meta['keywords'] or ''
+        meta['description'] = meta['description'] or ''
+        return meta
+
+    def extract_head_meta(self, raw_text):
+        # extract_meta of a page not preprocessed, with the entities
+        # decoded in the part of it extract_meta reads only
+        return self.extract_meta(self._entities.sub(self.decode_entity, raw_text[:self.title_size]))
 
     def extract_title(self, text):
-        match = self._title.search(text)
-        if not match:
-            match = self._title2.search(text)
-        if match:
-            title = match.groups()[0]
-            #title = self._special_char.sub(' ', title)
-            title = self._multi.sub(' ', title)
-        else: 
-            return ''
+        return self.extract_meta(text)['title']
+
+    def clean_title(self, title):
+        if title is None: return ''
         # remove noisy parts
         title_arr = re.split('\-|\||_', title) 
         title_scores = []
@@ -190,36 +549,91 @@ class SFExtractor(object):
         return new_title 
 
     def extract_keywords(self, text):
-        match = self._keywords.search(text)
-        if match:
-            title = match.groups()[0]
-            #title = self._special_char.sub(' ', title)
-            return self._multi.sub(' ', title)
-        return ''
+        return self.extract_meta(text)['keywords']
 
     def extract_description(self, text):
-        match = self._description.search(text)
-        if match:
-            title = match.groups()[0]
-            #title = self._special_char.sub(' ', title)
-            return self._multi.sub(' ', title)
-        return ''
-
-    def extract_content(self, text, thres):
+        return self.extract_meta(text)['description']
+
+    def extract_content(self, text, thres, title=''):
+        return self.extract_block(text, thres, title)[0]
+
+    def extract_block(self, text, thres, title='', prof=None, site=None, usage=None, url=None):
+        # content and its (istart, iend) line range
         # 2. remove tags, replace with newlines
-        text = self.remove_tags(text)
+        if prof: t = time.time()
+        lines = self.remove_tags(text)
+        if prof: prof.stage('remove_tags', t, len(text), len(lines))
 
         # 3. get blocks
-        lines = text.split('\n')
+        lines = LineIndex(lines)
         #for line in lines: print line
+        return self.select_block(lines, thres, title, prof, site, usage, url)
+
+    def select_block(self, lines, thres, title='', prof=None, site=None, usage=None, url=None):
+        if prof: t = time.time()
+        if usage: lines = usage.cut('lines', lines, usage.budget.max_lines)
         blocks = self.get_blocks(lines, thres)
-        if not blocks: return ''
+        if prof:
+            prof.stage('get_blocks', t, len(lines), len(blocks))
+            prof.count('lines', len(lines))
+            prof.count('blocks', len(blocks))
+        if not blocks: return '', None
+        if usage and usage.expired():
+            # out of time, the block with the most text
+            sums = [0]
+            for n in lines.lengths: sums.append(sums[-1] + n)
+            best_block = max(blocks, key=lambda b: sums[b[1]] - sums[b[0]])
+            return self.block_content(lines, best_block), best_block
 
         # 4. stat each block's text/stopword/link/punctuation densities
-        block_scores = self.stat_blocks(lines, blocks)
+        if prof: t = time.time()
+        # the site's known boilerplate blocks are neither scored nor merged,
+        # so their lines need no stats either
+        skip = None
+        template = site and self.templates and self.templates.get(site)
+        if template:
+            skip = [self.templates.is_boilerplate(template, lines, istart, iend) for istart, iend in blocks]
+            if all(skip): skip = None
+        # and neither are the shortest of the other blocks over the budget
+        max_blocks = usage and usage.budget.max_blocks
+        left = [i for i in xrange(len(blocks)) if not (skip and skip[i])]
+        if max_blocks is not None and len(left) > max_blocks:
+            usage.flag('blocks')
+            sums = [0]
+            for n in lines.lengths: sums.append(sums[-1] + n)
+            left.sort(key=lambda i: sums[blocks[i][0]] - sums[blocks[i][1]])
+            skip = list(skip or [False] * len(blocks))
+            for i in left[max_blocks:]: skip[i] = True
+        # the page's last version, for the lines and blocks that did not change
+        state = previous = None
+        if url and self.states is not None:
+            state = incremental.PageState(self.language, title, len(lines))
+            previous = self.states.get(url)
+            if previous is not None and not state.follows(previous): previous = None
+        if skip:
+            scored_lines = lines.blank(blocks[i] for i in xrange(len(blocks)) if skip[i])
+            stats = self.stat_lines(scored_lines, title, state, previous)
+        else:
+            stats = self.stat_lines(lines, title, state, previous)
+        if state is not None:
+            block_scores = [None if skip and skip[i] else self.rescore_block(stats, state, previous, blocks[i], prof)
+                            for i in xrange(len(blocks))]
+            state.done()
+            self.states.put(url, state)
+            if prof and previous is not None: prof.count('kept_lines', state.kept)
+        elif skip:
+            block_scores = [None if skip[i] else self.score_block(stats, *blocks[i]) for i in xrange(len(blocks))]
+        else:
+            block_scores = [self.score_block(stats, istart, iend) for istart, iend in blocks]
+        if prof:
+            prof.stage('stat_blocks', t, len(blocks), len(block_scores))
+            t = time.time()
 
         # 5. get the best block, and it's neighbours
-        best_idx, best_block, best_score = -1, None, max(block_scores) - 1
+        scores = [score for score in block_scores if score is not None]
+        # every block skipped, by a budget of no blocks
+        if not scores: return '', None
+        best_idx, best_block, best_score = -1, None, max(scores) - 1
         for i, score in enumerate(block_scores):
             if score > best_score:
                 best_idx = i
@@ -227,10 +641,15 @@ class SFExtractor(object):
                 best_score = score
 
         # 6. merge it's neighbours
+        steps = 0
         i = best_idx - 1 
         while i >= 0:
+            if skip and skip[i]: break
+            if usage and (usage.over('merge_steps', steps, usage.budget.max_merge_steps) or usage.expired()): break
+            steps += 1
             new_block = (blocks[i][0], best_block[1]) 
-            new_score = self.stat_blocks(lines, [new_block])[0] 
+            new_score = self.score_block(stats, *new_block)
+            if prof: prof.count('merge_steps')
             if new_score > best_score:
                 best_score = new_score
                 best_block = new_block
@@ -239,8 +658,12 @@ class SFExtractor(object):
                 break
         i = best_idx + 1
         while i < len(blocks):
+            if skip and skip[i]: break
+            if usage and (usage.over('merge_steps', steps, usage.budget.max_merge_steps) or usage.expired()): break
+            steps += 1
             new_block = (best_block[0], blocks[i][1]) 
-            new_score = self.stat_blocks(lines, [new_block])[0] 
+            new_score = self.score_block(stats, *new_block)
+            if prof: prof.count('merge_steps')
             if new_score > best_score:
                 best_score = new_score
                 best_block = new_block
@@ -248,102 +671,339 @@ class SFExtractor(object):
             else:
                 break
 
-        content = '\n'.join(lines[best_block[0]:best_block[1]])
-        content = self._multi.sub(' ', content) 
-        content = content.replace(self._link_mark, '')
-        return content
-
-    def check_from_annotation(self, text):
-        candi_list = []
-        for r in self._annotation_cases: 
-            s = r.search(text)
-            if s:
-                candi_list.extend(list(s.groups()))
-        if not candi_list: return ''
-        return '  '.join(candi_list)
-
-    def extract(self, raw_text, _thres=0):
-        if not raw_text: return '', '', '', ''
+        content = self.block_content(lines, best_block)
+        if prof: prof.stage('merge', t, len(blocks), len(content))
+        if site and self.templates:
+            self.templates.learn(site, lines, best_block)
+        return content, best_block
+
+    def block_content(self, lines, block):
+        content = self._multi.sub(' ', lines.join(*block)) 
+        return content.replace(self._link_mark, '')
+
+    def check_from_annotation(self, text, site=None):
+        # content of the region a marker rule of the site matches
+        if self.markers is None: return ''
+        match = self.markers.match(text, site)
+        if not match: return ''
+        (istart, iend), rule = match
+        content = self.remove_tags(text[istart:iend]).strip()
+        content = self._multi.sub(' ', content)
+        return content.replace(self._link_mark, '')
+
+    def cache_config(self, site=None):
+        # what besides the page and the threshold changes the result, None
+        # when earlier pages do too: a site's templates learn from each page
+        if site and self.templates is not None: return None
+        config = '%s:%r:%r' % (self.language, self.budget, self.fingerprint)
+        if self.markers is not None:
+            config += ':markers-%d:%s' % (self.markers.version, ','.join(self.markers.domains(site)))
+        return config
+
+    def extract(self, raw_text, _thres=0, site=None, usage=None, url=None):
+        # usage is a budget.Usage already started, by default self.budget's
+        # url keys the page's state in self.states
+        if not raw_text: return ExtractResult(degraded=usage and usage.degraded())
+        key = self.cache and self.cache.key(self, raw_text, _thres or self.min_block_len, site)
+        if key:
+            result = self.cache.get(key)
+            if result is not None: return result
+        prof = self.profiler and profiling.Profile()
+        usage = usage or (self.budget and self.budget.start())
+        if usage: raw_text = usage.cut('bytes', raw_text, usage.budget.max_bytes)
 
         # 1. remove newline characters
+        if prof: t = time.time()
         text = self.preprocess(raw_text)
+        if prof:
+            prof.stage('preprocess', t, len(raw_text), len(text))
+            t = time.time()
 
-        self.title = self.extract_title(text)
-        self.keywords = self.extract_keywords(text)
-        self.desc = self.extract_description(text)
+        meta = self.extract_meta(text)
+        if prof: prof.stage('metadata', t, len(text), len(meta['title']) + len(meta['keywords']) + len(meta['description']))
 
         # special process
-        content = '' #self.check_from_annotation(raw_text)
-        if content:
-            self.content = content
-        else:
-            self.content = self.extract_content(text, _thres or self.min_block_len)
-        return [self.title, self.content, self.keywords, self.desc]
+        if prof: t = time.time()
+        content, span = self.check_from_annotation(text, site), None
+        if prof and self.markers is not None: prof.stage('markers', t, len(text), len(content))
+        if not content:
+            content, span = self.extract_block(text, _thres or self.min_block_len, meta['title'], prof, site, usage, url)
+        return self.finish(meta, content, span, usage, prof, key)
+
+    def finish(self, meta, content, span, usage, prof, key):
+        # the page's result, fingerprinted, profiled and cached
+        result = ExtractResult(meta['title'], content, meta['keywords'], meta['description'], span,
+                               degraded=usage and usage.degraded(), og=meta['og'], charset=meta['charset'])
+        if self.fingerprint:
+            if prof: t = time.time()
+            self.fingerprint.fill(result)
+            if prof: prof.stage('fingerprint', t, len(content))
+        if prof:
+            if result.degraded: prof.count('degraded')
+            self.profiler(prof)
+        # a degraded result depends on the budget, and on time
+        if key and not result.degraded: self.cache.put(key, result)
+        return result
+
+    def stream(self, _thres=0, site=None, url=None):
+        return SFStream(self, _thres, site, url)
+
+    def extract_file(self, fp, _thres=0, chunk_size=65536, site=None, url=None):
+        stream = self.stream(_thres, site, url)
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk: break
+            stream.feed(chunk)
+        return stream.close()
+
+    def extract_many(self, texts, workers=None, chunksize=16, ordered=True, _thres=0):
+        return batch.extract_many(self.__class__, texts, workers, chunksize, ordered, _thres, batch.settings(self))
+
+    def extract_archive(self, path, workers=None, shard=None, ordered=True, _thres=0):
+        return archive.extract_archive(self.__class__, path, workers, shard, ordered=ordered, thres=_thres,
+                                       settings=batch.settings(self))
+
+class Incomplete(Exception):
+    # a construct may end in text not fed yet
+    pass
+
+class SFStream(object):
+    # feed() a page chunk by chunk, close() returns its ExtractResult, the
+    # same as extract() of the whole page with the same settings.
+    # markup is dropped as it is scanned, only the text from an unfinished
+    # construct on is buffered. what is kept is the head of the page (for
+    # meta data), the offset and length of each tag-stripped line, and the
+    # lines, which go to a temporary file once they pass spool_size bytes
+    # and are read back through a memory map, so that select_block only
+    # pages in the lines it reads.
+    # a page of a site with marker rules is kept whole too: its marked
+    # region is only known once the page is complete
+    head_size = 1 << 18
+    spool_size = 1 << 20
+    # a partial entity or newline pair at the end of a chunk
+    _entity_tail = re.compile(r'&[\w#;]*\Z|[\r\n]+\Z')
+
+    def __init__(self, extractor, thres=0, site=None, url=None):
+        self.extractor = extractor
+        self.thres = thres or extractor.min_block_len
+        self.site = site
+        self.url = url
+        self.usage = extractor.budget and extractor.budget.start()
+        # the cache key hashes the page as fed, like extract()'s
+        self.digest = hashlib.sha1() if extractor.cache else None
+        self.fed = False
+        self.size = 0
+        self.raw = ''
+        # entity-decoded text not scanned yet, in pieces
+        self.pending = []
+        self.pending_len = 0
+        self.retry = 0
+        self.head = []
+        self.head_len = 0
+        markers = extractor.markers
+        self.marked = [] if markers is not None and markers.matcher(site)[0] is not None else None
+        self.is_html = False
+        # the unfinished last line, in pieces
+        self.line = []
+        self.lines = []
+        self.lines_len = 0
+        self.offsets = array('i')
+        self.lengths = array('i')
+        self.spool = None
+        self.map = None
+
+    def feed(self, chunk):
+        if not chunk: return
+        self.fed = True
+        if self.digest: self.digest.update(chunk)
+        if self.usage and self.usage.budget.max_bytes is not None:
+            chunk = self.usage.cut('bytes', chunk, max(0, self.usage.budget.max_bytes - self.size))
+            self.size += len(chunk)
+        raw = self.raw + chunk
+        m = self._entity_tail.search(raw)
+        cut = m.start() if m else len(raw)
+        self.raw = raw[cut:]
+        self.push(raw[:cut])
+        # rescan an unfinished construct once the text has doubled
+        if self.pending_len >= self.retry:
+            self.scan(False)
+
+    def push(self, raw):
+        ext = self.extractor
+        text = ext._entities.sub(ext.decode_entity, raw)
+        if self.head_len < self.head_size:
+            self.head.append(text[:self.head_size-self.head_len])
+            self.head_len += len(self.head[-1])
+        if self.marked is not None: self.marked.append(text)
+        self.pending.append(text)
+        self.pending_len += len(text)
+
+    def scan(self, final):
+        ext = self.extractor
+        text = ''.join(self.pending)
+        content, end = ext.scan_tags(text, final)
+        if not self.is_html and ext.search(ext._html, text[:end]):
+            self.is_html = True
+        text = text[end:]
+        self.pending = [text]
+        self.pending_len = len(text)
+        self.retry = 2 * len(text)
+        lines = content.split('\n')
+        self.line.append(lines[0])
+        if len(lines) == 1: return
+        lines[0] = ''.join(self.line)
+        self.line = [lines.pop()]
+        for line in lines:
+            self.add_line(ext.normalize_line(line))
+
+    def add_line(self, line):
+        self.offsets.append(self.offsets[-1] + self.lengths[-1] + 1 if self.offsets else 0)
+        self.lengths.append(len(line))
+        if self.spool is not None:
+            self.spool.write('\n' + line)
+            return
+        self.lines.append(line)
+        self.lines_len += len(line) + 1
+        if self.lines_len > self.spool_size:
+            self.spool = tempfile.TemporaryFile()
+            self.spool.write('\n'.join(self.lines))
+            self.lines = []
+
+    def line_index(self):
+        # the tag-stripped lines, as one text
+        if self.spool is None:
+            return LineIndex('\n'.join(self.lines), self.offsets, self.lengths)
+        self.spool.flush()
+        self.map = mmap.mmap(self.spool.fileno(), 0, access=mmap.ACCESS_READ)
+        return LineIndex(self.map, self.offsets, self.lengths)
+
+    def release(self):
+        if self.map is not None: self.map.close()
+        if self.spool is not None: self.spool.close()
+        self.map = self.spool = None
+        self.lines = []
+
+    def close(self):
+        ext = self.extractor
+        if not self.fed: return ExtractResult()
+        key = self.digest and ext.cache.key(ext, None, self.thres, self.site, self.digest.hexdigest())
+        if key:
+            result = ext.cache.get(key)
+            if result is not None:
+                self.release()
+                return result
+        prof = ext.profiler and profiling.Profile()
+        self.push(self.raw)
+        self.raw = ''
+        self.scan(True)
+        self.add_line(ext.normalize_line(''.join(self.line)))
+        self.line = []
+
+        # what extract() does with the page preprocess() has kept, or ''
+        head = ''.join(self.head)
+        is_html = self.is_html and not ext.is_script(head)
+        if not is_html: head = ''
+        if prof: t = time.time()
+        meta = ext.extract_meta(head)
+        if prof: prof.stage('metadata', t, len(head), len(meta['title']) + len(meta['keywords']) + len(meta['description']))
+        text = ''.join(self.marked) if self.marked is not None and is_html else ''
+        self.marked = None
+        if prof: t = time.time()
+        content, span = ext.check_from_annotation(text, self.site), None
+        if prof and ext.markers is not None: prof.stage('markers', t, len(text), len(content))
+        if not content:
+            try:
+                lines = self.line_index() if is_html else LineIndex('')
+                content, span = ext.select_block(lines, self.thres, meta['title'], prof, self.site, self.usage, self.url)
+            finally:
+                self.release()
+        return ext.finish(meta, content, span, self.usage, prof, key)
+
+class LineStats(object):
+    # per-line features as prefix sums, a block of lines [istart, iend)
+    # is scored without touching its text
+    # only non-empty lines are kept: sums[k] is the total of the first k
+    # of them, lines their line numbers
+    def __init__(self, tot_line, title_set):
+        self.tot_line = tot_line
+        self.title_len = len(title_set) + 1.0
+        self.lines = array('I')
+        self.text_len = [0]
+        self.punc = [0]
+        self.link = [0]
+        self.stopword = [0]
+        # stop words split over lines, tail line and head line
+        self.pair_tails = []
+        self.pair_heads = []
+        # title char -> lines containing it
+        self.title_lines = dict((c, []) for c in title_set)
+
+    def span(self, istart, iend):
+        # (a, b): the non-empty lines in [istart, iend) are lines[a:b]
+        a = bisect.bisect_left(self.lines, istart)
+        if iend <= istart: return a, a
+        return a, bisect.bisect_left(self.lines, iend, a)
+
+    def count(self, sums, istart, iend):
+        a, b = self.span(istart, iend)
+        return sums[b] - sums[a]
+
+    def count_pairs(self, istart, iend):
+        # 'Copyright ©' split over lines of the block
+        if not self.pair_heads or iend <= istart: return 0
+        return max(0, bisect.bisect_left(self.pair_heads, iend) - bisect.bisect_left(self.pair_tails, istart))
+
+    def count_stopwords(self, istart, iend):
+        return self.count(self.stopword, istart, iend) + self.count_pairs(istart, iend)
+
+    def count_title(self, istart, iend):
+        n = 0
+        for c, lines in self.title_lines.iteritems():
+            i = bisect.bisect_left(lines, istart)
+            if i < len(lines) and lines[i] < iend:
+                n += 1
+        return n
 
 def download_and_normalize(url):
-    raw_html = urllib.urlopen(url).read()
-    if not raw_html:
-        return ''
-    best_match = ('', 0)
-    for charset in ['utf-8', 'gbk', 'big5', 'gb18030']:
-        try:
-            unicode_html = raw_html.decode(charset, 'ignore')
-            guess_html = unicode_html.encode(charset)
-            if len(guess_html) == len(raw_html):
-                best_match = (charset, len(guess_html))
-                break
-            elif len(guess_html) > best_match[1]:
-                best_match = (charset, len(guess_html))
-        except: 
-            pass
-    raw_html = raw_html.decode(best_match[0], 'ignore').encode('utf-8')
-    return raw_html
+    return fetch.download_and_normalize(url)
 
 def test():
+    # the saved pages in corpus/, see benchmark.py for the full suite
+    import benchmark
     ext = SFExtractor()
 
-    urls = [
-        'http://baike.baidu.com/view/25215.htm',
-        'http://tieba.baidu.com/p/3069273254',
-        'http://hi.baidu.com/handylee/blog/item/6523c4fc35a235fffc037fc5.html',
-        'http://xiezuoshi.baijia.baidu.com/article/15330',
-        'http://www.techweb.com.cn/news/2010-08-11/659082.shtml',
-        'http://www.ifanr.com/15876',
-        'http://news.cnhubei.com/xw/yl/201404/t2894467_5.shtml',
-        'http://blog.sina.com.cn/s/blog_673153e90101l8u8.html?tj=1',
-        ]
-
-    for url in urls:
-        raw_html = download_and_normalize(url)
-        if raw_html:
-            print '\nurl:', url
-            start_time = time.time()
-            for i in xrange(0, 10):
-                title, content, keywords, desc= ext.extract(raw_html)
-            end_time = time.time()
-            print 'QPS:', 10/ (end_time-start_time) 
-            print 'title:', title
-            print 'content:', content
-        else:
-            print '\nurl:', url
-            print 'error_msg:', err 
-
-def test_file(p_in):
-    ext = SFExtractor()
-    for url in open(p_in):
-        url = url.strip()
-        if not url: continue
-        raw_html = download_and_normalize(url)
-        if raw_html:
-            print '\nurl:', url
-            title, content, keywords, desc = ext.extract(raw_html)
-            print 'title:', title
-            print 'content:', content
+    for name, raw_html in benchmark.load_corpus():
+        print '\npage:', name
+        start_time = time.time()
+        for i in xrange(0, 10):
+            title, content, keywords, desc= ext.extract(raw_html)
+        end_time = time.time()
+        print 'QPS:', 10/ (end_time-start_time) 
+        print 'title:', title
+        print 'content:', content
+
+def test_file(p_in, cache_path=None):
+    urls = (url.strip() for url in open(p_in))
+    urls = (url for url in urls if url)
+    result_cache = cache_path and cache.ResultCache(path=cache_path)
+    for url, result, err in fetch.fetch_and_extract(SFExtractor, urls, settings={'cache': result_cache}):
+        print '\nurl:', url
+        if err:
+            print 'error_msg:', err
+            continue
+        title, content, keywords, desc = result
+        print 'title:', title
+        print 'content:', content
+    if result_cache:
+        print '\ncache:', result_cache.stats()
+        result_cache.close()
 
 if __name__ == '__main__':
     import sys
     if len(sys.argv)==2:
         test_file(sys.argv[1])
+    elif len(sys.argv)==3:
+        test_file(sys.argv[1], sys.argv[2])
     else:
         test()
 
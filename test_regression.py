@@ -0,0 +1,1024 @@
+#!/usr/bin/env python
+#coding: utf-8
+import os
+import re
+import math
+import tempfile
+import zlib
+import random
+import bisect
+import json
+import time
+import urllib2
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+import cache
+import markers
+import fingerprint
+import fetch
+import service
+import benchmark
+import sf_extractor
+import cx_extractor
+import lineindex
+import cascade
+import incremental
+import archive
+import batch
+import boilerplate
+import budget
+import languages
+import profiling
+from result import ExtractResult
+from cx_extractor import CXExtractor
+from sf_extractor import SFExtractor
+from lineindex import LineIndex
+
+# regressions of adversarial and failure cases, next to the corpus the
+# benchmark uses: python test_regression.py, or python -m unittest
+
+class ResultTest(unittest.TestCase):
+    def test_old_list_access(self):
+        result = ExtractResult('t', 'c', 'k', 'd', span=(1, 2))
+        title, content, keywords, desc = result
+        self.assertEqual((title, content, keywords, desc), ('t', 'c', 'k', 'd'))
+        self.assertEqual((result[0], result[1], result[-1]), ('t', 'c', 'd'))
+        self.assertEqual(result[1:3], ('c', 'k'))
+        self.assertEqual(len(result), 4)
+        self.assertEqual(list(result), ['t', 'c', 'k', 'd'])
+        self.assertRaises(IndexError, lambda: result[4])
+
+class ScannerTest(unittest.TestCase):
+    def test_unclosed_constructs(self):
+        # openers never closed, inside each other: SFExtractor's scanner
+        # resolves each one once, not once per opener before it
+        ext = SFExtractor()
+        units = [('style/script', '<style <script '), ('link', '<a '), ('comment', '<!--'),
+                 ('doctype', '<!DOCTYPE'), ('mixed', '<script <!-- <style <!DOCTYPE <a ')]
+        for name, unit in units:
+            page = '<html>' + unit * (300000 / len(unit))
+            start_time = time.time()
+            ext.scan_tags(page)
+            self.assertLess(time.time() - start_time, 2.0, name)
+        for page in ['<html>' + '<style <script ' * 200, '<html>' + '<a ' * 2000, '<html>' + '<!--' * 400]:
+            start_time = time.time()
+            ext.extract(page)
+            self.assertLess(time.time() - start_time, 1.0, page[:20])
+
+    def test_no_joins_across_removed_constructs(self):
+        # the regex cascade removed doctypes, then comments, and the text
+        # around a removed one could form a '-->' or '<!--'; the scanner
+        # resolves each construct in the page as it is
+        ext = SFExtractor()
+        for page, cascade_text, scanned in [
+                ('<!--<!--<!DOCTYPE html>><html>', '\n', '\n\n'),
+                ('<html><p>a<!-- x -<!DOCTYPE y>-> b</p><p>c</p>', '\n\na b\n\nc\n', '\n\na\n b\n\nc\n'),
+                ('<html><p>a<!<!DOCTYPE y>-- x --> b</p>', '\n\na b\n', '\n\na\n b\n')]:
+            text = ext.preprocess(page)
+            self.assertEqual(ext.scan_tags(text), (scanned, len(text)), page)
+            uncommented = ext._annotation.sub('', ext._doc_type.sub('', text))
+            self.assertNotEqual(ext.scan_tags(uncommented)[0], scanned, page)
+            self.assertEqual(ext.scan_tags(uncommented)[0], cascade_text, page)
+
+def baseline_tags(ext, text):
+    # SFExtractor.preprocess and remove_tags before the single-pass scanner
+    text = ext._new_line.sub(' ', text)
+    for r, c in ext._special_list:
+        text = r.sub(c, text)
+    text = ext._special_char.sub(' ', text)
+    text = ext._doc_type.sub('', text)
+    text = ext._annotation.sub('', text)
+    if not ext._html.search(text): return ''
+    if text.strip().startswith('document.write'): return ''
+    text = ext._javascript.sub('\n', text)
+    text = ext._css.sub('\n', text)
+    text = ext._link.sub(ext._link_mark, text)
+    text = ext._other_tag.sub('\n', text)
+    text = ext._start_spaces.sub('', text)
+    return ext._spaces.sub(' ', text)
+
+class ScannerBaselineTest(unittest.TestCase):
+    # random pages of whole tags and delimiters, with entities, line
+    # ends, letter case and unclosed openers; a removed doctype or comment
+    # never leaves halves of a delimiter on its sides (see ScannerTest)
+    tokens = ['<html>', '<HTML>', '<p>', '</P>', '<br>', '<div class="c">', '<img src=x>', '<span>', '</span>',
+              '<!DOCTYPE html>', '<!doctype html PUBLIC "x">', '<!-- c -->', '<!--c\nd-->', '<!--', '-->',
+              '<script>', '<SCRIPT type="t">', 'var a = 1 > 0;', '</script>', '</Script>', '<script',
+              '<style>', '<Style media=m>', '.c {}', '</style>', '</STYLE>', '<style ',
+              '<a href="u">', '<A HREF=u>', '</a>', '</A>', '<a ', '<a\nhref=u>', '<abbr>', '<!DOCTYPE',
+              '&amp;', '&AMP;lt;', '&amp;amp;gt;', '&nbsp;', '&#160;', '&#34;', '&copy;', '&lt;', '&Quot;', '&#x4e2d;',
+              '\r\n', '\n\r', '\r', '\n', '\t', ' ', '  ', 'text', 'More Text', '中文正文', '，']
+
+    def test_same_as_regexes(self):
+        ext = SFExtractor()
+        pages = [page for name, page in benchmark.load_corpus()]
+        rand = random.Random(4)
+        for i in xrange(3000):
+            page = ''.join(rand.choice(self.tokens) for _ in xrange(rand.randint(1, 40)))
+            pages.append(page if rand.random() < 0.1 else '<html>' + page)
+        pages += ['document.write("<p>x</p>")', '  document.write(1)<html>', '<xhtml>text']
+        for page in pages:
+            self.assertEqual(ext.remove_tags(ext.preprocess(page)), baseline_tags(ext, page), repr(page))
+
+class LinearPreprocessTest(unittest.TestCase):
+    # the linear scans replacing _ad_links, _comment_links and _special_tag
+    tokens = ['<a ', '<A  ', 'href=', 'HREF=', '"', "'", 'u', ' ', '\n', '>', '</a>', '</A>', '<span>',
+              '<span class="c">', '</span>', '<', 'x' * 45, 'y' * 20, '<p>', '<br>',
+              '<a  href=u x>', '<a class=c href="u" x>', '<A  HREF=\'u\' x >', 't', '<span>t</span>',
+              '<a  href=u x>t</a> ']
+
+    def test_same_as_regexes(self):
+        ext = CXExtractor()
+        rand = random.Random(1)
+        for i in xrange(2000):
+            text = ''.join(rand.choice(self.tokens) for _ in xrange(rand.randint(1, 60)))
+            self.assertEqual(ext.remove_runs(text, '\n', ext._ad_start, ext.ad_link_end),
+                             ext._ad_links.sub('\n', text), repr(text))
+            self.assertEqual(ext.remove_runs(text, '\n', ext._span_start, ext.comment_link_end),
+                             ext._comment_links.sub('\n', text), repr(text))
+            self.assertEqual(ext.remove_special_tags(text), ext._special_tag.sub('', text), repr(text))
+
+    def test_adversarial_pages(self):
+        # pages that made the regexes backtrack, 80000 units each
+        ext = CXExtractor()
+        for name, page in benchmark.adversarial_pages(80000):
+            start_time = time.time()
+            ext.preprocess(page)
+            self.assertLess(time.time() - start_time, 2.0, name)
+
+def baseline_blocks(line_lens, thres):
+    # SFExtractor.get_blocks before the prefix sums
+    tot_line = len(line_lens)
+    empty_blocks = []
+    istart = 0
+    for iend in xrange(0, tot_line):
+        if line_lens[iend] != 0 and iend > istart:
+            empty_blocks.append(iend - istart - 1)
+            istart = iend
+        if iend == tot_line - 1 and iend > istart:
+            empty_blocks.append(iend - istart - 1)
+    if not empty_blocks: return []
+    sort_list2 = []
+    for v in sorted(empty_blocks):
+        if v > 1: sort_list2.extend([v] * v)
+        else: sort_list2.append(v)
+    prop_interval = max(3, sort_list2[len(sort_list2)/5] + 1)
+    blocks = []
+    istart = 0
+    for iend in xrange(0, tot_line):
+        if sum(line_lens[iend:iend+prop_interval]) <= 3 and iend > istart:
+            if sum(line_lens[istart:iend]) >= thres:
+                blocks.append((istart, iend))
+            istart = iend + prop_interval
+            while istart < tot_line - 1 and line_lens[istart] <= 2:
+                istart += 1
+        if iend == tot_line - 1:
+            if sum(line_lens[istart:iend]) >= thres:
+                blocks.append((istart, iend))
+    return blocks
+
+_baseline_punc = re.compile(r',|\?|!|:|;|。|，|？|！|：|；|《|》|%|、|“|”', re.I|re.S)
+_baseline_stopword = re.compile(r'备\d+号|Copyright\s*©|版权所有|all rights reserved|广告|推广|回复|评论|关于我们|链接|About|'
+                                r'广告|下载|href=|本网|言论|内容合作|法律法规|原创|许可证|营业执照|合作伙伴|备案', re.I|re.S)
+
+def baseline_score(lines, istart, iend, title):
+    # SFExtractor.stat_blocks before the prefix sums, for one block
+    title_set = set(title.decode('utf-8', 'ignore'))
+    tot_line = len(lines)
+    block = '\n'.join(lines[istart:iend])
+    line_num = iend - istart + 1.0
+    clean_block = block.replace(SFExtractor._link_mark, '')
+    position_rate = (tot_line - istart + 1.0) / (tot_line + 1.0)
+    text_density = (len(clean_block) + 1.0) / line_num
+    punc_density = (len(_baseline_punc.findall(clean_block)) + 1.0) / line_num
+    link_density = (block.count(SFExtractor._link_mark) + 1.0) / line_num
+    stopword_density = (len(_baseline_stopword.findall(clean_block)) + 1.0) / line_num
+    matched_set = set(clean_block.decode('utf-8', 'ignore')) & title_set
+    title_match_rate = len(''.join(matched_set)) / (len(title_set) + 1.0)
+    score = position_rate * text_density
+    score *= math.pow(punc_density, 0.5)
+    score *= 1.0 + title_match_rate
+    score /= link_density
+    score /= math.pow(stopword_density, 0.5)
+    return score
+
+def baseline_meta(ext, text):
+    # SFExtractor's title, keywords and description regexes before the
+    # single pass over the head
+    def field(*regexes):
+        for r in regexes:
+            match = ext.search(r, text)
+            if match: return ext._multi.sub(' ', match.group(1))
+        return None
+    title = field(ext._title, ext._title2)
+    return ext.clean_title(title) if title is not None else '', \
+           field(ext._keywords) or '', field(ext._description) or ''
+
+class MetaTest(unittest.TestCase):
+    heads = ['<!DOCTYPE html>', '<meta charset="utf-8">', '<title>news - site_channel</title>',
+             '<meta name="keywords" content="a, b">', '<META NAME="Description" CONTENT="the\tdesc">',
+             '<meta property="og:title" content="og t">', '<meta name="viewport" content="w">',
+             '<link rel="x" href="y">', '<title>a\ntitle | s</title>']
+
+    def test_same_as_regexes(self):
+        ext = SFExtractor()
+        pages = [ext.preprocess(page) for name, page in benchmark.load_corpus()]
+        rand = random.Random(1)
+        for i in xrange(300):
+            head = ''.join(rand.choice(self.heads) for _ in xrange(rand.randint(0, 6)))
+            body = rand.choice(['', '<h1>heading_x</h1>']) + '<p>text</p>'
+            pages.append('<html><head>%s</head><body>%s</body></html>' % (head, body))
+        for page in pages:
+            meta = ext.extract_meta(page)
+            self.assertEqual((meta['title'], meta['keywords'], meta['description']), baseline_meta(ext, page),
+                             repr(page[:300]))
+
+    def test_og_and_charset(self):
+        page = ('<html><head><meta http-equiv="Content-Type" content="text/html; charset=gbk">'
+                '<meta property="og:title" content="The title"><meta property=\'og:url\' content=\'http://x/\'>'
+                '<META PROPERTY="og:title" CONTENT="second"><meta name="og:type" content=article>'
+                '<title>t</title></head><body><p>%s</p></body></html>' % ('some text, ' * 50))
+        meta = SFExtractor().extract_meta(page)
+        self.assertEqual(meta['charset'], 'gbk')
+        self.assertEqual(meta['og'], {'og:title': 'The title', 'og:url': 'http://x/', 'og:type': 'article'})
+        self.assertEqual(SFExtractor().extract_meta('<html><head><meta charset=utf-8></head>')['charset'], 'utf-8')
+        for ext in (SFExtractor(), cascade.CascadeExtractor()):
+            result = ext.extract(page)
+            self.assertEqual((result.og, result.charset), (meta['og'], 'gbk'))
+        self.assertEqual((CXExtractor().extract(page).og, CXExtractor().extract(page).charset), (None, None))
+        # results cached before og and charset
+        old = ExtractResult()
+        old.__setstate__(('t', 'c', 'k', 'd', None, None, None, None, None))
+        self.assertEqual((old.title, old.og, old.charset), ('t', None, None))
+
+class LineIndexTest(unittest.TestCase):
+    def test_same_as_split(self):
+        rand = random.Random(3)
+        for i in xrange(300):
+            text = ''.join(rand.choice(['', 'a', 'bc', ' ', '\n', '\n\n', 'line']) for _ in xrange(rand.randint(0, 40)))
+            split = text.split('\n')
+            indexes = [LineIndex(text)]
+            if lineindex.numpy is not None:
+                LineIndex.numpy_min_size = 0
+                try:
+                    indexes.append(LineIndex(text))
+                finally:
+                    LineIndex.numpy_min_size = 1 << 16
+            for lines in indexes:
+                self.assertEqual(list(lines), split)
+                self.assertEqual(list(lines.lengths), [len(line) for line in split])
+                self.assertEqual([lines[k] for k in xrange(len(lines))], split)
+                a = rand.randint(0, len(split))
+                b = rand.randint(a, len(split) + 2)
+                self.assertEqual(lines.join(a, b), '\n'.join(split[a:b]))
+                self.assertEqual(list(lines[a:b]), split[a:b])
+                blank = lines.blank([(a, b)])
+                self.assertEqual(list(blank.lengths), [0 if a <= k < b else len(line) for k, line in enumerate(split)])
+                self.assertEqual(list(lines.lengths), [len(line) for line in split])
+
+class ScoringTest(unittest.TestCase):
+    def test_same_as_baseline(self):
+        # every block and every run of neighbouring blocks of the corpus
+        # pages, scored from the prefix sums and from the joined text
+        ext = SFExtractor()
+        pages = [page for name, page in benchmark.load_corpus()]
+        pages.append('<html><body><p>Copyright\n\n&copy; 2020 版权所有</p><p>%s</p></body></html>' % ('正文，内容。' * 30))
+        for page in pages:
+            text = ext.preprocess(page)
+            title = ext.extract_meta(text)['title']
+            lines = LineIndex(ext.remove_tags(text))
+            blocks = ext.get_blocks(lines, ext.min_block_len)
+            stats = ext.stat_lines(lines, title)
+            plain = list(lines)
+            for i in xrange(len(blocks)):
+                for j in xrange(i, min(i + 4, len(blocks))):
+                    istart, iend = blocks[i][0], blocks[j][1]
+                    self.assertAlmostEqual(ext.score_block(stats, istart, iend),
+                                           baseline_score(plain, istart, iend, title), 9)
+
+class SegmentationTest(unittest.TestCase):
+    def test_same_as_baseline(self):
+        # python and numpy prefix sums against the original loops
+        rand = random.Random(2)
+        python, vectorized = SFExtractor(), SFExtractor()
+        vectorized.numpy_min_lines = 0
+        for i in xrange(500):
+            lens = [rand.choice([0, 0, 0, 0, 1, 2, 3, 8, 40, 120]) for _ in xrange(rand.randint(1, 300))]
+            lines = LineIndex('\n'.join('x' * n for n in lens))
+            expected = baseline_blocks(lens, 10)
+            self.assertEqual(python.get_blocks(lines, 10), expected, lens)
+            if sf_extractor.numpy is not None:
+                self.assertEqual(vectorized.get_blocks(lines, 10), expected, lens)
+            # a list of lines as before the line index
+            self.assertEqual(python.get_blocks(['x' * n for n in lens], 10), expected, lens)
+
+def baseline_cx_blocks(lens, width):
+    # CXExtractor.get_blocks before the prefix sums
+    lens = list(lens)
+    for i in range(len(lens) - 4):
+        if lens[i] == 0 and lens[i+1] == 0 and 0 < lens[i+2] < 2 and lens[i+3] == 0 and lens[i+4] == 0:
+            lens[i+2] = 0
+    return [sum(lens[i:i+width]) for i in range(len(lens))]
+
+class CXSegmentationTest(unittest.TestCase):
+    def test_same_as_baseline(self):
+        # python and numpy blocks, surges and dives against the original
+        # scans, find_surge and find_dive from every position
+        rand = random.Random(3)
+        python, vectorized = CXExtractor(), CXExtractor()
+        vectorized.numpy_min_lines = 0
+        for i in xrange(300):
+            lens = [rand.choice([0, 0, 0, 0, 0, 1, 1, 2, 8, 40, 120]) for _ in xrange(rand.randint(1, 120))]
+            lines = LineIndex('\n'.join('x' * n for n in lens))
+            thres = rand.choice([120, 150, 201])
+            blocks = baseline_cx_blocks(lens, python.block_width)
+            exts = [python, vectorized] if cx_extractor.numpy is not None else [python]
+            for ext in exts:
+                self.assertEqual(ext.get_blocks(lines, thres), blocks, lens)
+                self.assertEqual(ext.get_blocks(['x' * n for n in lens], thres), blocks, lens)
+                first_surges, surges = ext.get_surges(blocks, thres)
+                dives = ext.get_dives(blocks)
+                for start in xrange(len(blocks) + 1):
+                    for candidates, is_first_match in ((first_surges, True), (surges, False)):
+                        k = bisect.bisect_left(candidates, start)
+                        self.assertEqual(candidates[k] if k < len(candidates) else -1,
+                                         python.find_surge(blocks, start, thres, is_first_match), (blocks, start))
+                    k = bisect.bisect_left(dives, start)
+                    self.assertEqual(dives[k] if k < len(dives) else len(blocks) - 1,
+                                     python.find_dive(blocks, start), (blocks, start))
+        self.assertEqual(python.get_blocks([], 120), [])
+
+class FingerprintTest(unittest.TestCase):
+    def test_numpy_and_python_agree(self):
+        fp = fingerprint.Fingerprinter(perms=16)
+        contents = ['', 'ab', 'short', u'中文的正文，没有空格'.encode('utf-8'),
+                    benchmark.synthetic_page(2, size=20000)]
+        np = fingerprint.numpy
+        for content in contents:
+            a = fp.fill(ExtractResult(content=content))
+            fingerprint.numpy = None
+            try:
+                b = fp.fill(ExtractResult(content=content))
+            finally:
+                fingerprint.numpy = np
+            self.assertEqual((a.simhash, a.minhash), (b.simhash, b.minhash), repr(content[:20]))
+
+    def test_simhash_vote(self):
+        # the per-byte counts of the pure path against the bit-by-bit vote
+        # and numpy's
+        rand = random.Random(1)
+        for n in [1, 2, 3, 8, 100, 5000]:
+            hashes = [rand.getrandbits(64) for _ in xrange(n)]
+            if n == 100: hashes = [h & rand.getrandbits(64) for h in hashes]
+            expected = sum(1 << b for b in xrange(64) if sum(h >> b & 1 for h in hashes) * 2 > n)
+            self.assertEqual(fingerprint.simhash(hashes), expected, n)
+            if fingerprint.numpy is not None:
+                array = fingerprint.numpy.array(hashes, dtype=fingerprint.numpy.uint64)
+                self.assertEqual(fingerprint.simhash(array), expected, n)
+
+    def test_cached_results_per_setting(self):
+        # extractors sharing a cache each get fingerprints of their settings
+        page = benchmark.synthetic_page(4, size=20000)
+        shared = cache.ResultCache(10)
+        for fp in [None, fingerprint.Fingerprinter(perms=4), fingerprint.Fingerprinter(perms=8),
+                   fingerprint.Fingerprinter(simhash=False, perms=8, seed=2)]:
+            for cls in (SFExtractor, CXExtractor, cascade.CascadeExtractor):
+                ext = cls()
+                ext.cache = shared
+                ext.fingerprint = fp
+                result = ext.extract(page)
+                self.assertEqual(ext.extract(page), result)
+                expected = fp.fill(ExtractResult(content=result.content)) if fp else ExtractResult()
+                self.assertEqual((result.simhash, result.minhash), (expected.simhash, expected.minhash))
+        self.assertEqual(shared.stats()['hits'], 12)
+        # fill() replaces fingerprints of other settings
+        result = fingerprint.Fingerprinter(perms=4).fill(ExtractResult(content='some content'))
+        self.assertEqual(len(fingerprint.Fingerprinter(perms=8).fill(result).minhash), 8)
+
+class MarkerTest(unittest.TestCase):
+    def test_decoy_first_match(self):
+        # the first start marker is never closed, the second one is
+        page = ('<html><head><title>t</title></head><body><div id="art"><p>teaser, never closed'
+                '<div id="art"><p>the marked article</p></div></body></html>')
+        registry = markers.MarkerRegistry([('example.com', markers.MarkerRule('art', '<div id="art"'))])
+        region, rule = registry.match(page, 'example.com')
+        self.assertEqual(page[region[0]:region[1]], '<p>the marked article</p>')
+        ext = SFExtractor()
+        ext.markers = registry
+        self.assertEqual(ext.extract(page, site='example.com').content, 'the marked article')
+        self.assertEqual(registry.report(), ({'art': (2, 2), 'annotation': (0, 0)}, 0))
+
+    def test_default_annotation_rule(self):
+        # the comments _annotation_cases looked for, on every site
+        page = ('<html><head><title>t</title></head><body><!-- 正文开始 --><p>annotated content</p>'
+                '<!-- 正文结束 --><p>%s</p></body></html>' % ('plain statistics text, ' * 40))
+        ext = SFExtractor()
+        ext.markers = markers.MarkerRegistry()
+        self.assertEqual(ext.extract(page).content, 'annotated content')
+        self.assertEqual(ext.extract(page, site='example.com').content, 'annotated content')
+        ext.markers = markers.MarkerRegistry(defaults=False)
+        self.assertNotEqual(ext.extract(page).content, 'annotated content')
+        self.assertNotEqual(SFExtractor().extract(page).content, 'annotated content')
+
+    def test_cached_marker_result_per_site(self):
+        page = ('<html><head><title>t</title></head><body><div id="art">marked content</div>'
+                '<p>%s</p></body></html>' % ('plain statistics text, ' * 40))
+        ext = SFExtractor()
+        ext.cache = cache.ResultCache(10)
+        ext.markers = markers.MarkerRegistry([('example.com', markers.MarkerRule('art', '<div id="art"'))])
+        self.assertEqual(ext.extract(page, site='example.com').content, 'marked content')
+        self.assertNotEqual(ext.extract(page).content, 'marked content')
+        self.assertNotEqual(ext.extract(page, site='other.org').content, 'marked content')
+        self.assertEqual(ext.extract(page, site='www.example.com').content, 'marked content')
+
+class LanguageTest(unittest.TestCase):
+    def test_counts(self):
+        zh, en = languages.get('zh'), languages.get('en')
+        line = u'版权所有，Copyright © 2020：关于我们。广告！'
+        self.assertEqual(zh.count_punc(line), 4)
+        self.assertEqual(zh.count_stopwords(line.lower()), 4)
+        line = u'Read more: "Sign in", or sign up. All rights reserved.'
+        self.assertEqual(en.count_punc(line), 6)
+        self.assertEqual(en.count_stopwords(line.lower()), 4)
+        self.assertEqual(zh.count_punc(u'no marks here'), 0)
+        self.assertEqual(zh.count_stopwords(u'no stop words here'), 0)
+
+    def test_load(self):
+        fp = tempfile.NamedTemporaryFile(suffix='.json')
+        json.dump({'de': {'punctuation': [',', '.', u'„'], 'stopwords': ['impressum', 'datenschutz']}}, fp)
+        fp.flush()
+        languages.load(fp.name)
+        de = languages.get('de')
+        self.assertEqual(de.count_punc(u'„Impressum, Datenschutz.'), 3)
+        self.assertEqual(de.count_stopwords(u'„impressum, datenschutz.'), 2)
+        page = '<html><body><p>%s</p></body></html>' % ('Ein Satz, noch ein Satz. ' * 20)
+        ext = SFExtractor()
+        ext.language = 'de'
+        self.assertIn('Ein Satz, noch ein Satz.', ext.extract(page).content)
+        self.assertRaises(ValueError, languages.get, 'xx')
+
+class BatchTest(unittest.TestCase):
+    def test_same_as_extract(self):
+        # the workers' extractors have the settings of the one run
+        marked = ('<html><head><title>t</title></head><body><div id="art">marked content</div>'
+                  '<p>%s</p></body></html>' % ('plain statistics text, ' * 40))
+        pages = [page for name, page in benchmark.load_corpus()] + [marked]
+        ext = SFExtractor()
+        ext.markers = markers.MarkerRegistry([('*', markers.MarkerRule('art', '<div id="art"'))])
+        ext.language = 'en'
+        ext.min_block_len = 3
+        ext.fingerprint = fingerprint.Fingerprinter(simhash=True, perms=4)
+        expected = [ext.extract(page) for page in pages]
+        self.assertEqual(expected[-1].content, 'marked content')
+        for workers in (1, 2):
+            results = list(ext.extract_many(pages, workers=workers))
+            self.assertEqual([err for i, r, err in results], [''] * len(pages))
+            self.assertEqual([r for i, r, err in results], expected)
+
+    def test_cache_counts(self):
+        # the workers' lookups show in the extractor's cache stats
+        pages = [page for name, page in benchmark.load_corpus()]
+        fp = tempfile.NamedTemporaryFile(suffix='.db')
+        ext = SFExtractor()
+        ext.cache = cache.ResultCache(path=fp.name)
+        list(ext.extract_many(pages, workers=2))
+        self.assertEqual(ext.cache.stats()['misses'], len(pages))
+        list(ext.extract_many(pages, workers=2))
+        stats = ext.cache.stats()
+        self.assertEqual((stats['misses'], stats['disk_hits']), (len(pages), len(pages)))
+        ext.cache.close()
+
+    def test_marker_counts(self):
+        # the workers' rule matches show in the extractor's registry
+        marked = ('<html><head><title>t</title></head><body><div id="art">marked content %d</div>'
+                  '<p>%s</p></body></html>')
+        pages = [marked % (i, 'plain statistics text, ' * 40) for i in xrange(8)]
+        pages += [page for name, page in benchmark.load_corpus()]
+        for cls in (SFExtractor, cascade.CascadeExtractor):
+            reports = []
+            for workers in (1, 2):
+                ext = cls()
+                registry = markers.MarkerRegistry([('*', markers.MarkerRule('art', '<div id="art"'))])
+                if cls is SFExtractor: ext.markers = registry
+                else: ext.slow.markers = registry
+                list(ext.extract_many(pages, workers=workers))
+                reports.append(registry.report())
+            self.assertEqual(reports[1], reports[0], cls.__name__)
+            if cls is SFExtractor:
+                # one corpus page marks its content with the annotation
+                self.assertEqual(reports[0], ({'art': (8, 0), 'annotation': (1, 0)}, len(pages) - 9))
+
+class ArchiveTest(unittest.TestCase):
+    def test_single_worker_closes_map(self):
+        pages = [page for name, page in benchmark.load_corpus()]
+        fp = tempfile.NamedTemporaryFile(suffix='.html')
+        fp.write('\n'.join(pages))
+        fp.flush()
+        ext = SFExtractor()
+        results = list(archive.extract_archive(SFExtractor, fp.name, workers=1))
+        self.assertEqual([tuple(r) for uri, r, err in results], [tuple(ext.extract(page)) for page in pages])
+        self.assertIsNone(archive._archive)
+        # and when the caller stops early
+        results = archive.extract_archive(SFExtractor, fp.name, workers=1)
+        next(results)
+        self.assertIsNotNone(archive._archive)
+        results.close()
+        self.assertIsNone(archive._archive)
+
+    def warc_record(self, warc_type, uri, block, content_type='application/http; msgtype=response'):
+        return ('WARC/1.0\r\nWARC-Type: %s\r\nWARC-Target-URI: %s\r\nContent-Type: %s\r\n'
+                'Content-Length: %d\r\n\r\n%s\r\n\r\n' % (warc_type, uri, content_type, len(block), block))
+
+    def http(self, body, headers='Content-Type: text/html; charset=utf-8\r\n'):
+        return 'HTTP/1.1 200 OK\r\n%s\r\n%s' % (headers, body)
+
+    def test_warc(self):
+        pages = [page for name, page in benchmark.load_corpus()]
+        gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = gz.compress(pages[1]) + gz.flush()
+        chunked = ''.join('%x\r\n%s\r\n' % (len(pages[2][i:i+1000]), pages[2][i:i+1000])
+                          for i in xrange(0, len(pages[2]), 1000)) + '0\r\n\r\n'
+        records = [self.warc_record('warcinfo', '', 'software: test', 'application/warc-fields'),
+                   self.warc_record('request', 'http://a/0', 'GET /0 HTTP/1.1\r\nHost: a\r\n\r\n',
+                                    'application/http; msgtype=request'),
+                   self.warc_record('response', 'http://a/0', self.http(pages[0])),
+                   self.warc_record('response', 'http://a/1', self.http(gzipped, 'Content-Type: text/html\r\n'
+                                                                       'Content-Encoding: gzip\r\n')),
+                   self.warc_record('response', 'http://a/img', self.http('\x89PNG', 'Content-Type: image/png\r\n')),
+                   self.warc_record('response', 'http://a/2', self.http(chunked, 'Content-Type: text/html\r\n'
+                                                                       'Transfer-Encoding: chunked\r\n')),
+                   self.warc_record('metadata', 'http://a/2', 'fetchTimeMs: 1', 'application/warc-fields'),
+                   self.warc_record('response', 'http://a/3', self.http(pages[3]))]
+        fp = tempfile.NamedTemporaryFile(suffix='.warc')
+        fp.write(''.join(records))
+        fp.flush()
+        warc = archive.Archive(fp.name)
+        self.assertEqual([uri for uri, body, content_type in warc], ['http://a/%d' % i for i in xrange(4)])
+        self.assertEqual([body for uri, body, content_type in warc], pages[:4])
+        self.assertEqual(warc[0][2], 'text/html; charset=utf-8')
+        warc.close()
+
+        ext = SFExtractor()
+        expected = [('http://a/%d' % i, tuple(ext.extract(pages[i]))) for i in xrange(4)]
+        results = list(archive.extract_archive(SFExtractor, fp.name, workers=1))
+        self.assertEqual([(uri, tuple(r)) for uri, r, err in results], expected)
+        sharded = []
+        for k in xrange(3):
+            for uri, r, err in archive.extract_archive(SFExtractor, fp.name, workers=1, shard=(k, 3)):
+                sharded.append((uri, tuple(r)))
+        self.assertEqual(sharded, expected)
+        self.assertEqual(archive.shards(4, 3), [(0, 1), (1, 2), (2, 4)])
+
+    def test_compressed_archive(self):
+        gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        fp = tempfile.NamedTemporaryFile(suffix='.warc.gz')
+        fp.write(gz.compress(self.warc_record('response', 'http://a/0', self.http('<html></html>'))) + gz.flush())
+        fp.flush()
+        self.assertRaises(archive.ArchiveError, archive.Archive, fp.name)
+        self.assertRaises(archive.ArchiveError, list, archive.extract_archive(SFExtractor, fp.name, workers=1))
+
+class IncrementalTest(unittest.TestCase):
+    def test_recrawl_same_as_full(self):
+        # a changed page is extracted as if counted from scratch, with the
+        # unchanged lines kept from its last version
+        page = benchmark.synthetic_page(5, size=50000)
+        changed = page.replace('</body>', '<p>%s</p></body>' % ('a new paragraph, ' * 20), 1)
+        path = tempfile.NamedTemporaryFile(suffix='.db')
+        ext = SFExtractor()
+        ext.states = incremental.SqliteStore(path.name)
+        ext.profiler = stats = profiling.ProfileStats()
+        self.assertEqual(ext.extract(page, url='u'), SFExtractor().extract(page))
+        self.assertEqual(ext.extract(changed, url='u'), SFExtractor().extract(changed))
+        self.assertGreater(stats.report()['kept_lines']['sum'], 0)
+        ext.states.close()
+
+    def test_sqlite_eviction(self):
+        path = tempfile.NamedTemporaryFile(suffix='.db')
+        store = incremental.SqliteStore(path.name, size=10)
+        state = incremental.PageState('zh', 't', 0)
+        sizes = []
+        for i in xrange(40):
+            store.put('page%d' % i, state)
+            sizes.append(store.stats()['size'])
+        # evicted in batches, down to size once past size + margin
+        self.assertEqual(max(sizes), 11)
+        self.assertEqual(sizes[-1], 10)
+        self.assertIsNotNone(store.get('page39'))
+        # a new process counts the rows already there
+        store.close()
+        store = incremental.SqliteStore(path.name, size=10)
+        store.put('page40', state)
+        self.assertEqual(store.stats()['size'], 11)
+        store.put('page41', state)
+        self.assertEqual(store.stats()['size'], 10)
+        store.close()
+
+class BoilerplateTest(unittest.TestCase):
+    def test_template_skip(self):
+        # a navigation block every page of the site repeats is skipped once
+        # min_pages pages have it outside their content
+        gap = '<br>' * 12
+        nav = ''.join('<a href="/%d">栏目%d</a><br>' % (i, i) for i in xrange(6)) + '<p>站点公告：本站的长期公告文字，欢迎访问本站。</p>'
+        def page(i):
+            return '<html><head><title>文章%d</title></head><body>%s%s<div><p>%s</p></div>%s%s</body></html>' % \
+                   (i, nav, gap, ('这是第%d篇文章的正文，内容各不相同。' % i) * 10, gap, nav)
+        ext = SFExtractor()
+        ext.templates = boilerplate.BoilerplateCache(min_pages=3)
+        hits = []
+        for i in xrange(6):
+            self.assertEqual(ext.extract(page(i), site='example.com'), SFExtractor().extract(page(i)))
+            hits.append(ext.templates.stats()['hits'])
+        self.assertEqual(hits, [0, 0, 0, 1, 2, 3])
+        ext.extract(page(6), site='other.org')
+        self.assertEqual(ext.templates.stats()['hits'], 3)
+        self.assertEqual(ext.templates.stats()['sites'], 2)
+
+class BudgetTest(unittest.TestCase):
+    page = benchmark.synthetic_page(6, size=50000)
+
+    def extract(self, **limits):
+        ext = SFExtractor()
+        ext.budget = budget.Budget(**limits)
+        ext.cache = cache.ResultCache(10)
+        result = ext.extract(self.page)
+        # degraded results are not cached
+        self.assertEqual(ext.cache.stats()['size'], 0)
+        return result
+
+    def test_degraded(self):
+        ext = SFExtractor()
+        lines = LineIndex(ext.remove_tags(ext.preprocess(self.page)))
+        blocks = ext.get_blocks(lines, ext.min_block_len)
+        longest = max(blocks, key=lambda b: sum(lines.lengths[b[0]:b[1]]))
+        self.assertEqual(ext.extract(self.page).degraded, None)
+        # only the first max_bytes are read
+        result = self.extract(max_bytes=20000)
+        self.assertEqual(result.degraded, 'bytes')
+        self.assertEqual(tuple(result), tuple(ext.extract(self.page[:20000])))
+        # blocks end within the first max_lines lines
+        result = self.extract(max_lines=100)
+        self.assertEqual(result.degraded, 'lines')
+        self.assertLessEqual(result.span[1], 100)
+        # a single block scored is the content
+        result = self.extract(max_blocks=1)
+        self.assertEqual(result.degraded, 'blocks')
+        self.assertEqual(result.span, longest)
+        # no merging
+        result = self.extract(max_merge_steps=0)
+        self.assertEqual(result.degraded, 'merge_steps')
+        self.assertIn(result.span, blocks)
+        # out of time before scoring: the longest block
+        result = self.extract(deadline=0)
+        self.assertEqual(result.degraded, 'deadline')
+        self.assertEqual(result.span, longest)
+        self.assertEqual(result.content, ext.block_content(lines, longest))
+
+class ProfilingTest(unittest.TestCase):
+    def test_histograms(self):
+        h = profiling.Histogram()
+        for v in [0.5, 1, 3, 3, 100]: h.add(v)
+        self.assertEqual(h.to_dict()['buckets'], {1: 1, 2: 1, 4: 2, 128: 1})
+        self.assertEqual((h.count, h.max, h.percentile(50), h.percentile(99)), (5, 100, 4, 100))
+        stats = profiling.ProfileStats()
+        for cls in (SFExtractor, CXExtractor):
+            ext = cls()
+            ext.profiler = stats
+            for name, page in benchmark.load_corpus(): ext.extract(page)
+        report = stats.report()
+        pages = len(benchmark.load_corpus())
+        self.assertEqual(report['calls'], 2 * pages)
+        for stage in ('preprocess', 'metadata', 'get_blocks'):
+            self.assertEqual(report[stage + '.ms']['count'], 2 * pages, stage)
+        self.assertGreater(report['lines']['sum'], 0)
+        self.assertIn('merge_steps', stats.summary())
+
+    def test_pool_workers(self):
+        # the workers' profiles go to the extractor's profiler
+        pages = [page for name, page in benchmark.load_corpus()]
+        for cls in (SFExtractor, CXExtractor, cascade.CascadeExtractor):
+            ext = cls()
+            ext.profiler = stats = profiling.ProfileStats()
+            list(ext.extract_many(pages, workers=2))
+            self.assertEqual(stats.calls, len(pages), cls.__name__)
+            self.assertEqual(stats.report()['total_ms']['count'], len(pages), cls.__name__)
+        ext = SFExtractor()
+        ext.profiler = stats = profiling.ProfileStats()
+        fp = tempfile.NamedTemporaryFile(suffix='.html')
+        fp.write('\n'.join(pages))
+        fp.flush()
+        list(ext.extract_archive(fp.name, workers=2))
+        self.assertEqual(stats.calls, len(pages))
+        svc = service.ExtractService(SFExtractor, workers=2, settings=batch.settings(ext))
+        try:
+            svc.extract(pages[0])
+        finally:
+            svc.close()
+        self.assertEqual(stats.calls, len(pages) + 1)
+        self.assertEqual(stats.report()['preprocess.ms']['count'], len(pages) + 1)
+
+class StreamTest(unittest.TestCase):
+    marked = ('<html><head><title>t</title></head><body><div id="art">marked content</div>'
+              '<p>%s</p></body></html>' % ('plain statistics text, ' * 40))
+
+    def configure(self, ext):
+        ext.cache = cache.ResultCache(100)
+        ext.markers = markers.MarkerRegistry([('example.com', markers.MarkerRule('art', '<div id="art"'))])
+        ext.states = incremental.MemoryStore()
+        ext.fingerprint = fingerprint.Fingerprinter(perms=8)
+        return ext
+
+    def test_chunks_same_as_extract(self):
+        # with cache, markers, incremental states and fingerprints, and the
+        # lines spooled to a file; each page twice, the second time changed
+        pages = [(name, page, None) for name, page in benchmark.load_corpus()]
+        pages += [('synthetic', benchmark.synthetic_page(3, size=100000), None), ('marked', self.marked, 'example.com'),
+                  ('not html', 'plain text', None)]
+        for chunk_size in (1, 100, 4096):
+            ext, streamed = self.configure(SFExtractor()), self.configure(SFExtractor())
+            for version in (0, 1):
+                for name, page, site in pages:
+                    if version: page = page.replace('</body>', '<p>%s</p></body>' % ('a new paragraph, ' * 20), 1)
+                    url = 'http://example.com/' + name
+                    stream = streamed.stream(site=site, url=url)
+                    stream.spool_size = 1000
+                    for i in xrange(0, len(page), chunk_size):
+                        stream.feed(page[i:i+chunk_size])
+                    self.assertEqual(stream.close(), ext.extract(page, site=site, url=url), (name, chunk_size, version))
+            self.assertEqual(streamed.cache.stats(), ext.cache.stats())
+            self.assertEqual(streamed.markers.report(), ext.markers.report())
+            # the streamed results were cached
+            hits = streamed.cache.stats()['hits']
+            self.assertEqual(streamed.extract(self.marked, site='example.com').content, 'marked content')
+            self.assertEqual(streamed.cache.stats()['hits'], hits + 1)
+
+class CascadeTest(unittest.TestCase):
+    def test_cx_failure_goes_to_sf(self):
+        # no empty line: CXExtractor divides by zero, SFExtractor copes
+        page = '<html><body>' + 'a' * 300 + '</body></html>\nline two text\nline three'
+        self.assertRaises(ZeroDivisionError, CXExtractor().extract, page)
+        ext = cascade.CascadeExtractor()
+        result = ext.extract(page)
+        self.assertEqual(result.route, 'sf')
+        self.assertEqual(tuple(result), tuple(SFExtractor().extract(page)))
+        self.assertEqual(ext.stats(), {'cx': 0, 'sf': 1})
+
+    def test_empty_page(self):
+        # nothing left to count links in
+        page = '<html><head><title>t</title></head><body><p>%s</p></body></html>' % ('some text, ' * 50)
+        ext = cascade.CascadeExtractor()
+        self.assertEqual(ext.links(''), 0.0)
+        self.assertEqual(ext.extract(''), ExtractResult())
+        ext.budget = budget.Budget(max_bytes=0)
+        result = ext.extract(page)
+        self.assertEqual((result.content, result.degraded), ('', 'bytes'))
+        for cls in (SFExtractor, CXExtractor):
+            single = cls()
+            single.budget = budget.Budget(max_bytes=0)
+            result = single.extract(page)
+            self.assertEqual((result.content, result.degraded), ('', 'bytes'))
+
+    def test_same_meta_on_every_route(self):
+        # the cx route reads the head like SFExtractor does
+        sf = SFExtractor()
+        for name, page in benchmark.load_corpus():
+            expected = sf.extract(page)
+            for min_confidence in (0.0, 2.0):
+                ext = cascade.CascadeExtractor()
+                ext.min_confidence = min_confidence
+                ext.max_links = 1e9
+                result = ext.extract(page)
+                self.assertEqual(result.route, 'cx' if min_confidence == 0.0 else 'sf', name)
+                self.assertEqual((result.title, result.keywords, result.description),
+                                 (expected.title, expected.keywords, expected.description), name)
+
+    def test_links(self):
+        ext = cascade.CascadeExtractor()
+        self.assertEqual(ext.links('<a href=u><A\thref=u><a\nhref=u><abbr><b>' + 'x' * 961), 3.0)
+
+class CharsetTest(unittest.TestCase):
+    # get_charset's bounded samples
+    zh, big5_only, traditional = u'中文内容新闻', u'一丁七丈三上下', u'內容資訊'
+
+    def page(self, text, charset, meta=None):
+        head = '<meta http-equiv="Content-Type" content="text/html; charset=%s">' % meta if meta else ''
+        return ('<html><head>%s<title>t</title></head><body><p>' % head) + \
+               (text * 10).encode(charset) + '</p></body></html>'
+
+    def test_declared(self):
+        # big5 bytes gbk also decodes, only a declaration picks big5
+        page = self.page(self.traditional, 'big5')
+        self.assertEqual(fetch.get_charset(page), 'gbk')
+        self.assertEqual(fetch.get_charset(page, 'text/html; charset=big5'), 'big5')
+        self.assertEqual(fetch.get_charset(page, 'text/html; charset="Big5"'), 'big5')
+        self.assertEqual(fetch.get_charset(self.page(self.traditional, 'big5', 'big5')), 'big5')
+        self.assertEqual(fetch.normalize(page, 'text/html; charset=big5'),
+                         page.decode('big5').encode('utf-8'))
+        # the header before the meta, gb2312 read as gbk
+        page = self.page(self.zh, 'gbk', 'big5')
+        self.assertEqual(fetch.get_charset(page, 'text/html; charset=gb2312'), 'gbk')
+
+    def test_wrong_declaration(self):
+        page = self.page(self.zh, 'gbk')
+        for content_type in ('text/html; charset=utf-8', 'text/html; charset=iso-8859-1',
+                             'text/html; charset=no-such-charset'):
+            self.assertEqual(fetch.get_charset(page, content_type), 'gbk', content_type)
+        self.assertEqual(fetch.get_charset(self.page(self.zh, 'gbk', 'utf-8')), 'gbk')
+        self.assertEqual(fetch.get_charset(self.page(self.zh, 'utf-8', 'gbk')), 'utf-8')
+
+    def test_fallback_order(self):
+        for text, charset in [(self.zh, 'utf-8'), (self.zh, 'gbk'), (self.big5_only, 'big5'),
+                              (u'㐀', 'gb18030'), (u'', 'utf-8')]:
+            page = self.page(text, charset)
+            self.assertEqual(fetch.get_charset(page), charset, repr(text))
+            self.assertEqual(fetch.normalize(page), page.decode(charset).encode('utf-8'), repr(text))
+
+    def test_same_as_legacy(self):
+        pages = [(name, open(os.path.join(benchmark.corpus_dir, name), 'rb').read())
+                 for name in sorted(os.listdir(benchmark.corpus_dir))]
+        for name, page in pages + benchmark.charset_pages(size=20000):
+            self.assertEqual(fetch.normalize(page), benchmark.legacy_normalize(page), name)
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # the corpus pages at /<name>, a redirect to one of them, a 404 and a
+    # page over the fetcher's size cap, over keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.connections.add(self.client_address)
+        status, headers, body = 200, {'Content-Type': 'text/html'}, ''
+        if self.path == '/redirect':
+            status, headers['Location'] = 302, '/' + sorted(server.pages)[0]
+        elif self.path == '/big':
+            body = 'x' * (server.max_size + 1)
+        elif self.path[1:] in server.pages:
+            body = server.pages[self.path[1:]]
+        else:
+            status = 404
+        self.send_response(status)
+        for k, v in headers.items(): self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FetchTest(unittest.TestCase):
+    def fixture_server(self):
+        server = FixtureServer(('127.0.0.1', 0), FixtureHandler)
+        server.pages = {}
+        for name in os.listdir(benchmark.corpus_dir):
+            with open(os.path.join(benchmark.corpus_dir, name), 'rb') as fp:
+                server.pages[name] = fp.read()
+        server.max_size = 1 << 20
+        server.lock = threading.Lock()
+        server.requests = 0
+        server.connections = set()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def test_fixture_server(self):
+        server = self.fixture_server()
+        try:
+            base = 'http://127.0.0.1:%d/' % server.server_address[1]
+            names = sorted(server.pages) * 3
+            urls = [base + name for name in names] + [base + 'redirect', base + 'missing', base + 'big']
+            results = {}
+            for url, result, err in fetch.fetch_and_extract(SFExtractor, urls, fetchers=2, workers=2,
+                                                            max_size=server.max_size):
+                results[url] = (result, err)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(results), len(set(urls)))
+        ext = SFExtractor()
+        for name in names:
+            result, err = results[base + name]
+            self.assertEqual(err, '')
+            self.assertEqual(tuple(result), tuple(ext.extract(fetch.normalize(server.pages[name]))), name)
+        # the redirect is followed
+        result, err = results[base + 'redirect']
+        self.assertEqual(tuple(result), tuple(results[base + sorted(server.pages)[0]][0]))
+        # a 404 and a body over max_size are fetch errors
+        self.assertEqual(results[base + 'missing'], (None, 'FetchError: HTTP 404: %smissing' % base))
+        result, err = results[base + 'big']
+        self.assertTrue(err.startswith('FetchError: larger than'), err)
+        # one connection per fetcher, and one more after the oversize body
+        self.assertEqual(server.requests, len(urls) + 1)
+        self.assertLessEqual(len(server.connections), 3)
+
+    def test_closed_early(self):
+        # the feeder and the fetchers stop with the consumer
+        server = self.fixture_server()
+        try:
+            base = 'http://127.0.0.1:%d/' % server.server_address[1]
+            urls = [base + name for name in sorted(server.pages)] * 50
+            results = fetch.fetch_and_extract(SFExtractor, urls, fetchers=2, workers=1)
+            url, result, err = next(results)
+            self.assertEqual(err, '')
+            results.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        targets = [getattr(t, '_Thread__target', None) for t in threading.enumerate()]
+        self.assertNotIn(fetch._feed, targets)
+        self.assertNotIn(fetch._fetch, targets)
+        self.assertLess(server.requests, len(urls))
+
+    def test_failing_urls(self):
+        # the url before the failure is handed back, then the failure
+        def urls():
+            yield 'http://127.0.0.1:1/'
+            raise ValueError('bad url list')
+        items = []
+        def run():
+            try:
+                for item in fetch.fetch_and_extract(SFExtractor, urls(), fetchers=2, workers=1):
+                    items.append(item)
+            except ValueError as e:
+                items.append(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(15)
+        self.assertFalse(thread.is_alive(), 'fetch_and_extract hung')
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0][0], 'http://127.0.0.1:1/')
+        self.assertTrue(items[0][2])
+        self.assertEqual(str(items[1]), 'bad url list')
+
+class ServiceTest(unittest.TestCase):
+    # a page slow enough to time out and to keep a worker busy
+    slow_page = benchmark.synthetic_page(0, size=2000000)
+    page = benchmark.synthetic_page(1, size=20000)
+
+    def start(self, **kwargs):
+        self.server = service.serve(0, **kwargs)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.service.close()
+
+    def post(self, body, headers={}):
+        try:
+            return urllib2.urlopen(urllib2.Request(self.url + '/extract', body, headers)).code
+        except urllib2.HTTPError as e:
+            return e.code
+
+    def metrics(self):
+        return json.loads(urllib2.urlopen(self.url + '/metrics').read())
+
+    def wait_idle(self):
+        for i in xrange(600):
+            if self.metrics()['in_flight'] == 0: return
+            time.sleep(0.05)
+        self.fail('pages still in flight')
+
+    def test_overload(self):
+        self.start(workers=1, queue_size=0)
+        codes = []
+        threads = [threading.Thread(target=lambda: codes.append(self.post(self.slow_page))) for i in xrange(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertIn(200, codes)
+        self.assertIn(503, codes)
+        self.assertEqual(self.metrics()['shed'], codes.count(503))
+
+    def test_timeouts_keep_their_place(self):
+        # timed out pages still run, new pages are shed until they finish
+        self.start(workers=1, queue_size=1, timeout=0.05)
+        self.assertEqual(self.post(self.slow_page), 504)
+        self.assertEqual(self.post(self.slow_page), 504)
+        self.assertEqual(self.metrics()['in_flight'], 2)
+        self.assertEqual(self.post(self.page), 503)
+        self.wait_idle()
+        self.server.service.timeout = 30
+        self.assertEqual(self.post(self.page), 200)
+
+    def test_compressed_bomb(self):
+        # 1 MB of gzip inflating to 200 MB
+        self.start(workers=1, max_size=1 << 20)
+        gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        bomb = gz.compress('\0' * (200 << 20)) + gz.flush()
+        self.assertLess(len(bomb), 1 << 20)
+        self.assertEqual(self.post(bomb, {'Content-Encoding': 'gzip'}), 413)
+        self.assertEqual(self.post(zlib.compress(self.page), {'Content-Encoding': 'deflate'}), 200)
+        self.assertEqual(self.post('not gzip', {'Content-Encoding': 'gzip'}), 400)
+        self.assertEqual(self.metrics()['bad_requests'], 2)
+
+if __name__ == '__main__':
+    unittest.main()